@@ -1,6 +1,21 @@
-
 from . import srt_io
-from .trained_logistic_regression import TrainedLogisticRegression
 
-# main scriptable entry point
-from .main import synchronize
+# The main entry points are imported lazily (PEP 562) so that importing the
+# package, e.g., for autosubsync --help, does not import numpy
+_lazy_attributes = {
+    'synchronize': 'main',
+    'synchronize_many': 'main',
+    'TrainedLogisticRegression': 'trained_logistic_regression'
+}
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+        module = importlib.import_module('.' + _lazy_attributes[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_attributes.keys()))
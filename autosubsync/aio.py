@@ -0,0 +1,190 @@
+"""
+asyncio version of the synchronization API for services that run many
+synchronizations concurrently in one event loop.
+
+ffmpeg runs as an asyncio subprocess whose output is read without blocking
+the event loop, and the CPU work (features, speech detection and the
+transform search) runs in a concurrent.futures executor. Cancelling the
+task kills ffmpeg and removes the partial output. Work already running in
+the executor cannot be interrupted: it runs to completion and its result
+is discarded.
+
+Usage:
+    success = await autosubsync.aio.synchronize_async(video_file, \
+        subtitle_file, output_file)
+"""
+import asyncio
+import functools
+import os
+
+import numpy as np
+
+# search parameters supported by synchronize_async, the other options of
+# synchronize (e.g., sampled_segments or subtitle_stream) are not
+search_parameters = ['fixed_skew', 'max_shift_secs', 'coarse_shift_secs', \
+    'estimate_skew', 'max_segment_shift_secs', 'verbose']
+
+async def stream_sound_async(input_video_file, block_size, sample_rate=20000, \
+    resampler='swr'):
+    """
+    Async generator version of preprocessing.stream_sound. If the generator
+    is closed early or the consuming task is cancelled, ffmpeg is killed
+
+    Yields:
+        numpy int16 arrays of block_size samples (the last may be shorter)
+
+    Throws:
+        RuntimeError if ffmpeg fails
+    """
+    from autosubsync import preprocessing
+
+    proc = await asyncio.create_subprocess_exec( \
+        *preprocessing.ffmpeg_command(['-i', input_video_file] + \
+            preprocessing.pcm_output_args(sample_rate, resampler)),
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, \
+        stderr=asyncio.subprocess.PIPE)
+
+    # read stderr concurrently so that ffmpeg never blocks on it
+    stderr = asyncio.ensure_future(proc.stderr.read())
+
+    completed = False
+    try:
+        while True:
+            try:
+                data = await proc.stdout.readexactly(block_size*2)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+            if len(data) < 2: break
+            yield np.frombuffer(data[:(len(data)//2*2)], dtype='<i2')
+        completed = True
+    finally:
+        if not completed:
+            if proc.returncode is None: proc.kill()
+            # the pipe must reach EOF before the process counts as finished
+            await proc.stdout.read()
+        await proc.wait()
+        stderr_data = await stderr
+
+    if proc.returncode != 0:
+        raise preprocessing.ffmpeg_error(proc.returncode, stderr_data)
+
+async def detect_speech_async(video_file, trained_model, executor=None, \
+    parallelism=3, sample_rate=20000, fft_workers=None):
+    """
+    Speech probability of each frame of the audio in a video file, see
+    main.detect_speech. At most parallelism audio chunks are processed in
+    the executor at a time while ffmpeg decodes the next ones
+    """
+    from autosubsync import features
+    from autosubsync import model
+
+    loop = asyncio.get_running_loop()
+    frame_size = int(features.frame_secs*sample_rate)
+    chunk_size = features.chunk_size_samples(frame_size)
+    compute = functools.partial(features.compute_chunk_features, data_range=2**15, \
+        frame_size=frame_size, frame_secs=features.frame_secs, fft_workers=fft_workers)
+
+    sound_blocks = stream_sound_async(video_file, chunk_size, sample_rate)
+    pending = []
+    feature_chunks = []
+    try:
+        async for block in sound_blocks:
+            pending.append(loop.run_in_executor(executor, compute, block))
+            if len(pending) >= max(parallelism, 1):
+                feature_chunks.append(await pending.pop(0))
+        while pending:
+            feature_chunks.append(await pending.pop(0))
+    finally:
+        for future in pending: future.cancel()
+        # kills ffmpeg if still running
+        await sound_blocks.aclose()
+
+    # same result as predict_stream on the chunks
+    return await loop.run_in_executor(executor, model.predict, trained_model, \
+        np.vstack(feature_chunks))
+
+def _remove(path):
+    try: os.unlink(path)
+    except OSError: pass
+
+async def synchronize_async(video_file, subtitle_file, output_file, \
+    model_file=None, trained_model=None, return_parameters=False, executor=None, \
+    parallelism=3, sample_rate=20000, fft_workers=None, segmented=False, \
+    cache_dir=None, cache_max_bytes=2**30, **kwargs):
+    """
+    Automatically synchronize subtitles with audio in a video file without
+    blocking the event loop, see synchronize
+
+    Args:
+        video_file (string): Input video file name
+        subtitle_file (string): Input SRT subtitle file name
+        output_file (string): Output (synchronized) SRT subtitle file name,
+            written only if the synchronization completes
+        model_file (string): Model file, None for the packaged model
+        trained_model (tuple): If given, use this already loaded model (see
+            model.load) instead of loading model_file
+        executor (concurrent.futures.Executor): Executor for the CPU work,
+            default is the default executor of the event loop. A process
+            pool executor runs it without holding the GIL of the event loop
+        parallelism (int): Maximum number of audio chunks of this video
+            processed in the executor at a time
+        sample_rate, fft_workers, segmented, cache_dir, cache_max_bytes:
+            as in synchronize
+        other arguments: search parameters as in synchronize, see
+            search_parameters for the supported ones
+
+    Returns:
+        the same as synchronize
+
+    Raises:
+        TypeError: if other options are given
+    """
+    from autosubsync import srt_io
+    from autosubsync.main import _format_result, _load_model, _speech_cache_key, \
+        _sync_subtitles
+
+    # fail before any work is done
+    unsupported = sorted(k for k in kwargs if k not in search_parameters)
+    if unsupported:
+        raise TypeError('synchronize_async does not support: %s' % ', '.join(unsupported))
+
+    loop = asyncio.get_running_loop()
+
+    # first check that the SRT file is valid before extracting any audio data
+    subtitles = await loop.run_in_executor(executor, srt_io.check_file, subtitle_file)
+
+    if trained_model is None:
+        trained_model = await loop.run_in_executor(executor, _load_model, model_file)
+
+    y_scores = None
+    if cache_dir is not None:
+        from autosubsync import cache
+        speech_cache = cache.SpeechCache(cache_dir, cache_max_bytes)
+        cache_key = await loop.run_in_executor(executor, _speech_cache_key, \
+            speech_cache, video_file, trained_model, sample_rate)
+        y_scores = await loop.run_in_executor(executor, speech_cache.get, cache_key)
+
+    if y_scores is None:
+        y_scores = await detect_speech_async(video_file, trained_model, executor, \
+            parallelism=parallelism, sample_rate=sample_rate, fft_workers=fft_workers)
+        if cache_dir is not None:
+            y_scores = await loop.run_in_executor(executor, speech_cache.put, \
+                cache_key, y_scores)
+
+    # write to a temporary file, renamed once complete, so that a cancelled
+    # synchronization never leaves a partial output file
+    temp_file = '%s.%d-%x.tmp' % (output_file, os.getpid(), id(y_scores))
+    job = loop.run_in_executor(executor, functools.partial(_sync_subtitles, \
+        subtitles, temp_file, y_scores, trained_model[1], parallelism=1, \
+        segmented=segmented, sample_rate=sample_rate, **kwargs))
+    try:
+        result = await asyncio.shield(job)
+    except asyncio.CancelledError:
+        job.add_done_callback(lambda _: _remove(temp_file))
+        raise
+    except Exception:
+        _remove(temp_file)
+        raise
+    os.replace(temp_file, output_file)
+
+    return _format_result(result, segmented, return_parameters)
@@ -0,0 +1,235 @@
+"""
+Batch synchronization of many videos with a fixed pool of worker processes.
+
+Jobs are read from a manifest (CSV or JSON lines with the columns
+video_file, subtitle_file, output_file), grouped by video so that speech
+is detected only once per video, and run in a process pool where each
+worker loads the model once. Workers run one job at a time, so the ffmpeg
+decoding of one job overlaps with the CPU work of the others.
+
+One JSON line per subtitle file is appended to a report file as soon as
+its job completes, with the synchronization result, the time spent in each
+stage (see profiling.Profiler), the profiler counters and the parameters
+used. Jobs already successfully present in the report are
+skipped, so an interrupted batch can be resumed by running it again.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+manifest_columns = ['video_file', 'subtitle_file', 'output_file']
+
+def read_manifest(path):
+    """
+    Read a job manifest
+
+    Args:
+        path (string): a JSON lines file (.jsonl, .json) with objects
+            containing the keys video_file, subtitle_file and output_file,
+            or a CSV file with these columns, either with a header row or
+            in this order without one
+
+    Returns:
+        a list of dicts with the keys video_file, subtitle_file, output_file
+    """
+    jobs = []
+    with open(path) as f:
+        if path.lower().endswith('.jsonl') or path.lower().endswith('.json'):
+            for line in f:
+                if not line.strip(): continue
+                row = json.loads(line)
+                jobs.append(dict((k, row[k]) for k in manifest_columns))
+        else:
+            rows = [r for r in csv.reader(f) if r]
+            if rows and set(manifest_columns).issubset(rows[0]):
+                index = [rows[0].index(k) for k in manifest_columns]
+                rows = [[r[i] for i in index] for r in rows[1:]]
+            for r in rows:
+                if len(r) < len(manifest_columns):
+                    raise RuntimeError('invalid manifest row: %s' % ','.join(r))
+                jobs.append(dict(zip(manifest_columns, r)))
+    return jobs
+
+def _job_key(record):
+    return tuple(record[k] for k in manifest_columns)
+
+def read_finished(report_file):
+    "Keys of the jobs successfully processed in an existing report"
+    finished = set()
+    if not os.path.exists(report_file): return finished
+    with open(report_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # e.g., a line truncated by an interruption
+            if 'error' not in record:
+                finished.add(_job_key(record))
+    return finished
+
+def group_by_video(jobs):
+    "Group jobs to (video_file, [(subtitle_file, output_file), ...]) in order"
+    groups = []
+    index = {}
+    for job in jobs:
+        video_file = job['video_file']
+        if video_file not in index:
+            index[video_file] = len(groups)
+            groups.append((video_file, []))
+        groups[index[video_file]][1].append((job['subtitle_file'], job['output_file']))
+    return groups
+
+# per worker process state, see _init_worker
+_worker = {}
+
+def _init_worker(model_file, sync_kwargs):
+    from autosubsync.main import _load_model
+    _worker['model'] = _load_model(model_file)
+    _worker['kwargs'] = sync_kwargs
+
+def _run_job(job):
+    """
+    Synchronize all subtitle files of one video
+
+    Returns:
+        a list of report records, one per subtitle file
+    """
+    from autosubsync import main
+    from autosubsync import profiling
+    from autosubsync import srt_io
+
+    video_file, pairs = job
+    trained_model = _worker['model']
+    kwargs = dict(_worker['kwargs'])
+    detect_kwargs = dict((k, kwargs.pop(k)) for k in \
+        ['sample_rate', 'sampled_segments', 'sampled_segment_secs', \
+         'cache_dir', 'cache_max_bytes', 'fft_workers'] if k in kwargs)
+
+    records = [dict(zip(manifest_columns, (video_file, sub, out)), \
+        parameters=_worker['kwargs']) for sub, out in pairs]
+    try:
+        subtitles = [srt_io.check_file(sub) for sub, _ in pairs]
+
+        speech_profiler = profiling.Profiler()
+        y_scores = main.detect_speech(video_file, trained_model, \
+            parallelism=1, profiler=speech_profiler, **detect_kwargs)
+        speech_report = speech_profiler.report()
+    except Exception as e:
+        for r in records: r['error'] = '%s: %s' % (type(e).__name__, e)
+        return records
+
+    for record, sub, (_, out) in zip(records, subtitles, pairs):
+        try:
+            profiler = profiling.Profiler()
+            success, quality, skew, shift, segments = main._sync_subtitles( \
+                sub, out, y_scores, trained_model[1], parallelism=1, \
+                sample_rate=detect_kwargs.get('sample_rate', 20000), \
+                profiler=profiler, **kwargs)
+            fit_report = profiler.report()
+            # the speech detection stages are shared by all subtitle files
+            # of the same video
+            timings = dict((k, v['wall_secs']) for report in [speech_report, fit_report] \
+                for k, v in report['stages'].items())
+            record.update({
+                'success': bool(success),
+                'quality': float(quality),
+                'skew': float(skew),
+                'shift': float(shift),
+                'timings': timings,
+                'counters': dict(speech_report['counters'], **fit_report['counters'])
+            })
+            if segments is not None:
+                record['segments'] = [dict((k, float(v)) for k, v in s.items()) \
+                    for s in segments]
+        except Exception as e:
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return records
+
+def run_batch(manifest, report_file, parallelism=3, model_file=None, \
+    verbose=False, parallel_backend='process', **kwargs):
+    """
+    Synchronize all jobs in a manifest, appending results to a report
+
+    Args:
+        manifest (string or list): manifest file name or a list of dicts as
+            returned by read_manifest
+        report_file (string): JSON lines report file, appended to
+        parallelism (int): number of workers
+        parallel_backend (string): worker pool type, see features.Executor
+        model_file (string): model file, None for the packaged model
+        verbose (boolean): print progress information
+        other arguments: passed to synchronize, see ``autosubsync --help``
+
+    Returns:
+        a list of the report records written in this run
+    """
+    if not isinstance(manifest, list): manifest = read_manifest(manifest)
+    finished = read_finished(report_file)
+    jobs = [j for j in manifest if _job_key(j) not in finished]
+    groups = group_by_video(jobs)
+    parallelism = max(min(parallelism, len(groups)), 1)
+
+    if verbose:
+        print('%d job(s) in manifest, %d already done, %d video(s) to process using %d worker(s)' % \
+            (len(manifest), len(manifest) - len(jobs), len(groups), parallelism))
+
+    if parallelism > 1:
+        if parallel_backend == 'thread':
+            from multiprocessing.pool import ThreadPool as Pool
+        else:
+            import multiprocessing
+            start_method = None if parallel_backend == 'process' else parallel_backend
+            Pool = multiprocessing.get_context(start_method).Pool
+        pool = Pool(parallelism, initializer=_init_worker, initargs=(model_file, kwargs))
+        results = pool.imap_unordered(_run_job, groups)
+    else:
+        pool = None
+        _init_worker(model_file, kwargs)
+        results = (_run_job(g) for g in groups)
+
+    written = []
+    try:
+        with open(report_file, 'a') as report:
+            for records in results:
+                for record in records:
+                    report.write(json.dumps(record, sort_keys=True) + '\n')
+                    written.append(record)
+                    if verbose:
+                        if 'error' in record:
+                            status = 'ERROR ' + record['error'].split('\n')[0]
+                        else: status = 'quality %.3f%s' % (record['quality'], \
+                            '' if record['success'] else ' (FAILED)')
+                        print('[%d/%d] %s: %s' % (len(written), len(jobs), \
+                            record['subtitle_file'], status))
+                report.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return written
+
+def cli(packaged_model=False, argv=None):
+    from autosubsync.main import add_sync_arguments, sync_arguments
+
+    p = argparse.ArgumentParser(prog='autosubsync batch',
+        description=__doc__.strip().split('\n\n')[0])
+    p.add_argument('manifest',
+        help='CSV or JSON lines (.jsonl) file with the columns ' + \
+            ', '.join(manifest_columns))
+    p.add_argument('report_file',
+        help='JSON lines report file. Jobs already in it are skipped')
+    add_sync_arguments(p, packaged_model)
+    args = p.parse_args(argv)
+
+    records = run_batch(args.manifest, args.report_file, \
+        verbose=not args.silent, **sync_arguments(args, packaged_model))
+
+    n_failed = len([r for r in records if not r.get('success')])
+    if n_failed > 0:
+        sys.stderr.write("\nWARNING: %d of %d subtitle file(s) failed, see %s\n" % \
+            (n_failed, len(records), args.report_file))
+        sys.exit(1)
@@ -0,0 +1,149 @@
+"""
+Persistent on-disk cache of speech detection results, i.e., the speech
+probability of each frame, so that syncing several subtitle files against
+the same video does not repeat audio extraction and speech detection.
+
+Entries are keyed by a fingerprint of the video file contents, the model
+and the analysis parameters, stored as float16 .npy files and evicted in
+least-recently-used order when the cache grows too large. Writes are atomic
+(write to a temporary file and rename) so the cache can be shared by many
+processes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+# bump this if the stored data or the key changes in incompatible ways
+format_version = 1
+
+default_max_bytes = 2**30
+
+def file_fingerprint(path, n_samples=16, sample_size=2**16):
+    """
+    Content fingerprint of a file: a hash of its size and evenly spaced
+    samples of its contents, so that huge files need not be read fully
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        if size <= n_samples * sample_size:
+            h.update(f.read())
+        else:
+            for i in range(n_samples):
+                f.seek(i * (size - sample_size) // (n_samples - 1))
+                h.update(f.read(sample_size))
+    return h.hexdigest()
+
+def model_fingerprint(trained_model):
+    "Hash identifying a trained model"
+    from . import model
+    return hashlib.sha256(model.serialize(trained_model).encode('utf-8')).hexdigest()
+
+class SpeechCache:
+    """
+    Size-bounded LRU cache of speech probability vectors in a directory
+    """
+    def __init__(self, directory, max_bytes=default_max_bytes):
+        """
+        Args:
+            directory (string): cache directory, created if necessary
+            max_bytes (int): maximum total size of the cached entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            try: os.makedirs(directory)
+            except OSError: pass # created concurrently
+
+    def key(self, video_file, trained_model, params):
+        """
+        Cache key for speech detection results
+
+        Args:
+            video_file (string): video file name
+            trained_model: model used for speech detection
+            params (dict): any other analysis parameters affecting the result
+        """
+        data = json.dumps([format_version, file_fingerprint(video_file), \
+            model_fingerprint(trained_model), params], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """
+        Returns:
+            the cached speech probabilities (float64 numpy array) or None
+        """
+        path = self._path(key)
+        try:
+            y_scores = np.load(path).astype(np.float64)
+            os.utime(path, None) # mark as recently used
+            return y_scores
+        except (IOError, OSError, ValueError):
+            # missing, evicted concurrently or corrupted
+            return None
+
+    def put(self, key, y_scores):
+        """
+        Store speech probabilities and evict old entries if necessary
+
+        Returns:
+            the stored probabilities, rounded to the storage precision so
+            that results do not depend on whether the cache was hit
+        """
+        stored = np.asarray(y_scores, dtype=np.float16)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, stored)
+            os.replace(tmp_path, self._path(key))
+        except:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+
+        self.evict()
+        return stored.astype(np.float64)
+
+    def evict(self):
+        "Delete least recently used entries until the cache fits in max_bytes"
+        with self._lock():
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.npy'): continue
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+                except OSError:
+                    pass
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes: break
+                try: os.unlink(os.path.join(self.directory, name))
+                except OSError: pass
+                total -= size
+
+    def _lock(self):
+        "Inter-process lock for eviction (no-op where fcntl is unavailable)"
+        return _FileLock(os.path.join(self.directory, '.lock'))
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        try:
+            import fcntl
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, *args):
+        self.file.close() # releases the lock
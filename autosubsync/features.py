@@ -3,6 +3,7 @@ import os
 import sys
 
 from . import preprocessing
+from . import sharedmem
 
 frame_secs = 0.05
 
@@ -34,28 +35,70 @@ def rolling_aggregates(frames, width=1, aggregate=np.mean):
         result[:, feature_index] = aggregate(windows, axis=1)
     return result
 
-def apply_windowing(frames):
-    extended = expand_to_adjacent(frames)
-    window = np.hanning(extended.shape[1])
-    return extended * window[np.newaxis,:]
-
-def compute_spectra(windowed, window_length_secs):
-    spectrum = np.abs(np.fft.rfft(windowed, axis=1))
-    frequency = np.arange(spectrum.shape[1]) / window_length_secs
-    audible = (frequency > 20) & (frequency < 20000)
-
-    spectrum = spectrum[:, audible]
-    return spectrum.astype(np.float32)
-
-def compute_banks(spectra, n_banks):
-    bank_size = int(spectra.shape[1] / n_banks)
-    banks = []
-    for i in range(n_banks):
-        begin = i*bank_size
-        end = (i+1)*bank_size
-        bank = spectra[:,begin:end]
-        banks.append(np.log1p(np.sqrt(np.sum(bank**2, axis=1))[:,np.newaxis]))
-    return np.hstack(banks)
+def sliding_max(vec, width, fill_value=-np.inf):
+    """
+    Maximum of vec[i-width:i+width+1] for each i, where values outside vec
+    are fill_value. O(n) van Herk / Gil-Werman algorithm. For a matrix,
+    the maxima are computed for each column
+    """
+    vec = np.asarray(vec)
+    n = len(vec)
+    window = 2*width + 1
+    n_blocks = (n + 2*width + window - 1) // window
+    padded = np.full((n_blocks*window,) + vec.shape[1:], fill_value, \
+        dtype=np.result_type(vec, type(fill_value)))
+    padded[width:(width+n)] = vec
+    blocks = np.reshape(padded, (n_blocks, window) + vec.shape[1:])
+    shape = padded.shape
+    prefix = np.reshape(np.maximum.accumulate(blocks, axis=1), shape)
+    suffix = np.reshape(np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1], shape)
+    return np.maximum(suffix[:n], prefix[(window-1):(window-1+n)])
+
+def adjacent_frame_windows(frames):
+    """
+    Read-only view of shape (n_frames, 3, frame_size) whose row i contains
+    the frames i+1, i and i-1 (zeros outside), i.e., the same data as
+    expand_to_adjacent(frames) but without copying the frames three times
+    """
+    n_frames, frame_size = frames.shape
+    padded = np.zeros((n_frames + 2, frame_size), dtype=frames.dtype)
+    padded[1:-1] = frames
+    row_stride, item_stride = padded.strides
+    return np.lib.stride_tricks.as_strided(padded[2:], \
+        shape=(n_frames, 3, frame_size), \
+        strides=(row_stride, -row_stride, item_stride), writeable=False)
+
+def apply_windowing(frames, scale=1.0):
+    "Hanning-windowed adjacent frames as a single precision matrix"
+    n_frames, frame_size = frames.shape
+    window = (np.hanning(3*frame_size) * scale).astype(np.float32)
+    windowed = np.multiply(adjacent_frame_windows(frames), \
+        np.reshape(window, (3, frame_size)), dtype=np.float32)
+    return np.reshape(windowed, (n_frames, 3*frame_size))
+
+# default number of threads used by each FFT if scipy.fft is available
+fft_workers = 1
+
+def rfft(windowed, workers=None):
+    "Real FFT of each row, single precision for single precision input"
+    if workers is None: workers = fft_workers
+    try:
+        import scipy.fft
+    except ImportError:
+        return np.fft.rfft(windowed, axis=1)
+    return scipy.fft.rfft(windowed, axis=1, workers=workers)
+
+def audible_bins(n_bins, window_length_secs):
+    "Slice of the audible (20Hz - 20kHz) FFT bins"
+    frequency = np.arange(n_bins) / window_length_secs
+    audible = np.flatnonzero((frequency > 20) & (frequency < 20000))
+    return slice(audible[0], audible[-1] + 1)
+
+def bank_energies(power, n_banks):
+    "log1p of the root of the total power in each of n_banks equal bins"
+    bank_size = int(power.shape[1] / n_banks)
+    power = np.reshape(power[:, :(n_banks*bank_size)], (len(power), n_banks, bank_size))
+    return np.log1p(np.sqrt(np.sum(power, axis=2)))
 
 def split_to_chunks(n, chunk_size):
     i_begin = 0
@@ -64,40 +107,157 @@ def split_to_chunks(n, chunk_size):
         yield(slice(i_begin, i_end))
         i_begin = i_end
 
-def maybe_parallel_map(f, data, parallelism=1):
-    if parallelism > 1:
-        from multiprocessing import Pool
-        try:
-            pool = Pool(parallelism)
-            return pool.map(f, data)
-        finally:
-            pool.close()
+class Executor:
+    """
+    Long-lived pool of parallel workers that can be reused across calls,
+    e.g., for feature computation and the transform search of several
+    synchronizations, instead of starting a new process pool each time
+
+    Usage:
+        with Executor(4, backend='thread') as executor:
+            autosubsync.synchronize(..., executor=executor)
+    """
+    backends = ['process', 'thread', 'fork', 'forkserver', 'spawn']
+
+    def __init__(self, parallelism=3, backend='process'):
+        """
+        Args:
+            parallelism (int): number of workers
+            backend (string): 'thread' for a thread pool (numpy FFTs and
+                reductions release the GIL), 'process' for a process pool
+                using the default start method or 'fork', 'forkserver'
+                or 'spawn' for a process pool using that start method
+        """
+        if backend not in self.backends:
+            raise ValueError('unknown executor backend %s' % backend)
+        self.parallelism = parallelism
+        self.backend = backend
+        if backend == 'thread':
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(parallelism)
+        else:
+            import multiprocessing
+            start_method = None if backend == 'process' else backend
+            self.pool = multiprocessing.get_context(start_method).Pool(parallelism)
+
+    def map(self, f, data):
+        return self.pool.map(f, data)
+
+    def imap(self, f, data):
+        """
+        Lazy map: consumes at most parallelism items of the (possibly
+        generator) data at a time and yields results in order
+        """
+        batch = []
+        for item in data:
+            batch.append(item)
+            if len(batch) == self.parallelism:
+                for result in self.pool.map(f, batch): yield result
+                batch = []
+        for result in self.pool.map(f, batch): yield result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        "Stop the workers without waiting for pending work, e.g., on interrupt"
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def maybe_parallel_map(f, data, parallelism=1, executor=None):
+    if executor is not None:
+        return executor.map(f, data)
+    elif parallelism > 1:
+        with Executor(parallelism) as executor:
+            return executor.map(f, data)
     else:
         return [f(c) for c in data]
 
-def compute_chunk_features(sound_data_chunk, data_range, frame_size, frame_secs):
-    training_x = split_to_frames(sound_data_chunk, frame_size)
-    spectra = compute_spectra(apply_windowing(training_x)/float(data_range), 3*frame_secs)
-    return compute_banks(spectra, n_banks=50)
+def maybe_parallel_imap(f, data, parallelism=1, executor=None):
+    """
+    Lazy version of maybe_parallel_map: consumes at most parallelism items
+    of the (possibly generator) data at a time and yields results in order
+    """
+    if executor is not None:
+        for result in executor.imap(f, data): yield result
+    elif parallelism > 1:
+        with Executor(parallelism) as executor:
+            for result in executor.imap(f, data): yield result
+    else:
+        for item in data: yield f(item)
+
+def compute_chunk_features(sound_data_chunk, data_range, frame_size, frame_secs, \
+    fft_workers=None):
+    sound_data_chunk = sharedmem.attach(sound_data_chunk)
+    frames = split_to_frames(sound_data_chunk, frame_size)
+    windowed = apply_windowing(frames, scale=1.0/data_range)
+    spectrum = rfft(windowed, fft_workers)
+    del windowed
+    # bank energies directly from the power spectrum of the audible bins
+    # instead of going through the magnitudes
+    spectrum = spectrum[:, audible_bins(spectrum.shape[1], 3*frame_secs)]
+    power = np.square(spectrum.real) + np.square(spectrum.imag)
+    return bank_energies(power, n_banks=50).astype(np.float32)
 
 def _compute_chunk_features_star(args):
     return compute_chunk_features(*args)
 
-def compute(sound_data, subvec, parallelism=3):
+# features are computed in chunks of this many seconds
+chunk_size_secs = 120
+
+def chunk_size_samples(frame_size):
+    "Number of audio samples in a feature chunk (whole frames)"
+    return int(chunk_size_secs / frame_secs) * frame_size
+
+def compute_stream(sound_blocks, sample_rate, data_range, parallelism=3, executor=None, \
+    fft_workers=None):
+    """
+    Compute features for a stream of consecutive audio blocks. Each block
+    (normally chunk_size_samples long) is processed as one chunk and at most
+    parallelism blocks are held in memory at a time. Runs in the given
+    Executor or in a temporary process pool if executor is None. Each FFT
+    uses fft_workers threads if scipy is available
+
+    Yields:
+        feature matrices, one for each block
+    """
+    frame_size = int(frame_secs*sample_rate)
+    n_slots = executor.parallelism if executor is not None else parallelism
+
+    # pass the audio to worker processes through a ring of shared buffers,
+    # reused batch by batch, instead of pickling each block
+    with sharedmem.SharedArrays(sharedmem.uses_processes(parallelism, executor)) as shared:
+        chunks = ((shared.share_in_slot(i % n_slots, block), data_range, \
+            frame_size, frame_secs, fft_workers) for i, block in enumerate(sound_blocks))
+        for chunk_x in maybe_parallel_imap(_compute_chunk_features_star, chunks, \
+            parallelism, executor):
+            yield chunk_x
+
+def compute(sound_data, frame_labels, parallelism=3, executor=None, fft_workers=None):
+    """
+    Features and labels of all frames for training
+
+    Args:
+        sound_data (tuple): (samples, sample_rate, data_range)
+        frame_labels (np.array): subtitle label of each frame, see
+            preprocessing.build_frame_labels
+    """
     samples, sample_rate, data_range = sound_data
     frame_size = int(frame_secs*sample_rate)
 
     # compute features in chunks
-    chunk_size_secs = 120
-    chunk_size = int(chunk_size_secs / frame_secs)
-    chunks = list(split_to_chunks(len(samples), chunk_size))
-
-    def compute_chunk_labels(chunk):
-        return np.round(np.mean(split_to_frames(subvec[chunk], frame_size), axis=1)).astype(np.float32)
-
-    data_chunks = [(samples[c], data_range, frame_size, frame_secs) for c in chunks]
-    all_x = np.vstack(maybe_parallel_map(_compute_chunk_features_star, data_chunks, parallelism))
-    all_y = np.hstack([compute_chunk_labels(c) for c in chunks])
+    chunks = split_to_chunks(len(samples), chunk_size_samples(frame_size))
+    sound_blocks = (samples[c] for c in chunks)
+    all_x = np.vstack(list(compute_stream(sound_blocks, sample_rate, data_range, \
+        parallelism, executor, fft_workers)))
+    all_y = np.asarray(frame_labels[:len(all_x)], dtype=np.float32)
     return all_x, all_y
 
 def normalize_by_file(data_x, normalize_func, file_labels=None):
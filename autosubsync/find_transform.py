@@ -1,7 +1,9 @@
 import numpy as np
 
-from .features import frame_secs, maybe_parallel_map
+from .features import frame_secs, maybe_parallel_map, sliding_max
+from . import profiling
 from . import quality_of_fit
+from . import sharedmem
 
 def score_function(labels, probs):
     "Score for binary labels vs probabilistic predictions"
@@ -28,11 +30,118 @@ def sub_score_transform(y_true, y_probs, func):
 def sub_score(y_true, y_probs, shift=0, skew=1.0):
     return sub_score_transform(y_true, y_probs, lambda x: x*skew + shift*frame_secs)
 
+def fft_length(n):
+    "Smallest power of two that is at least n"
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+def skew_frame_labels(y_true, skew):
+    """
+    Move subtitle labels according to skew (but no shift), as done in
+    sub_score_transform: the label of frame i goes to frame round(i*skew)
+    and, if several frames map to the same target, the last one wins.
+
+    Returns:
+        tuple (labels, mass), where labels is a binary vector of moved labels
+        and mass[k] is the total label value moved to frame k
+    """
+    targets = np.round(np.arange(len(y_true))*skew).astype(int)
+    n_targets = targets[-1] + 1 if len(targets) > 0 else 0
+    labels = np.zeros(n_targets)
+    labels[targets] = y_true == 1
+    mass = np.bincount(targets, weights=y_true, minlength=n_targets)
+    return labels, mass
+
+def score_values(y_probs):
+    "Per-frame score contributions 2p - 1 of labels, 0 for NaN (not analyzed) frames"
+    values = 2*np.asarray(y_probs, dtype=float) - 1
+    values[np.isnan(values)] = 0
+    return values
+
+def shift_score_curve(y_true, y_probs, shifts, skew=1.0):
+    """
+    Compute sub_score for a range of integer (frame) shifts at once.
+
+    The score is linear in the shifted labels, so all shifts can be evaluated
+    with a single FFT-based cross-correlation of the skewed labels and the
+    speech probabilities. The result equals that of sub_score (up to floating
+    point rounding), including the missed-fraction penalty, except for the
+    rounding of exact half-frame ties: here the label of frame i always goes
+    to frame round(i*skew) + shift (ties to even, as np.round), independent
+    of the shift, whereas sub_score rounds the floating point time and may
+    round a tie either way depending on the shift. This affects, e.g., the
+    skews 25/24 and 23.976/24 (at every 12th frame).
+
+    Frames whose speech probability is NaN are treated as not analyzed
+    and excluded from the score.
+
+    Args:
+        y_true (array-like): subtitle labels (0 or 1) for each frame
+        y_probs (array-like): speech probabilities for each frame (or NaN)
+        shifts (range): consecutive shifts in frames
+        skew (float): skew / speed multiplier
+
+    Returns:
+        numpy array of scores, one for each shift
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    y_probs = np.asarray(y_probs, dtype=float)
+    n = len(y_true)
+    labels, mass = skew_frame_labels(y_true, skew)
+    m = len(labels)
+
+    # score = (sum((1 - p)) + sum(labels_shifted * (2p - 1))) / n
+    size = fft_length(n + m)
+    correlation = np.fft.irfft(np.fft.rfft(score_values(y_probs), size) * \
+        np.conj(np.fft.rfft(labels, size)), size)
+
+    shifts = np.arange(shifts.start, shifts.stop)
+    overlapping = (shifts > -m) & (shifts < n)
+    matched = np.zeros(len(shifts))
+    matched[overlapping] = correlation[shifts[overlapping] % size]
+
+    # labels moved outside the frame range are penalized
+    cum_mass = np.concatenate([[0], np.cumsum(mass)])
+    kept_mass = cum_mass[np.clip(n - shifts, 0, m)] - cum_mass[np.clip(-shifts, 0, m)]
+    missed_fraction = cum_mass[-1] - kept_mass
+    penalty_factor = 1.0 - missed_fraction / float(n)
+
+    analyzed = ~np.isnan(y_probs)
+    return (np.sum(1.0 - y_probs[analyzed]) + matched) / float(np.sum(analyzed)) * penalty_factor
+
+def padded_slice(vec, begin, end, fill_value):
+    "vec[begin:end] where indices outside vec are filled with fill_value"
+    result = np.full(end - begin, fill_value, dtype=float)
+    lo, hi = max(begin, 0), min(end, len(vec))
+    if hi > lo: result[(lo-begin):(hi-begin)] = vec[lo:hi]
+    return result
+
+def window_correlations(labels, values, bounds, shifts, fill_value=-1.0):
+    """
+    Local cross-correlations of label windows and a value vector, i.e.,
+    sum(labels[k] * values[k + shift] for k in range(begin, end)) for each
+    (begin, end) in bounds and each shift. Values outside the vector are
+    replaced by fill_value.
+
+    Returns:
+        numpy array of shape (len(bounds), len(shifts))
+    """
+    n_shifts = len(shifts)
+    result = np.zeros((len(bounds), n_shifts))
+    if len(bounds) == 0: return result
+    size = fft_length(max(end - begin for begin, end in bounds) + n_shifts - 1)
+    for i, (begin, end) in enumerate(bounds):
+        window = labels[begin:end]
+        if not np.any(window): continue
+        segment = padded_slice(values, begin + shifts.start, end + shifts.stop - 1, fill_value)
+        result[i, :] = np.fft.irfft(np.fft.rfft(segment, size) * \
+            np.conj(np.fft.rfft(window, size)), size)[:n_shifts]
+    return result
+
 def compute_shift_scores(y_subs, y_probs, max_shift_secs=20.0, skew=1.0, base_shift_secs=0.0):
     min_shift = int((base_shift_secs - max_shift_secs)/frame_secs)
     max_shift = int((base_shift_secs + max_shift_secs)/frame_secs)+1
     shifts = range(min_shift, max_shift)
-    scores = [sub_score(y_subs, y_probs, shift, skew) for shift in shifts]
+    scores = shift_score_curve(y_subs, y_probs, shifts, skew)
     return shifts, scores
 
 def best_shift(*args, **kwargs):
@@ -42,7 +151,68 @@ def best_shift(*args, **kwargs):
     return [shifts[best_idx]*frame_secs, scores[best_idx], quality]
 
 def _best_shift_star(args):
-    return best_shift(*args)
+    y_subs, y_probs = [sharedmem.attach(a) for a in args[:2]]
+    return best_shift(y_subs, y_probs, *args[2:])
+
+def theil_sen(x, y):
+    "Robust line fit: median of pairwise slopes. Returns slope and intercept"
+    i, j = np.triu_indices(len(x), k=1)
+    valid = x[j] != x[i]
+    slope = np.median((y[j] - y[i])[valid] / (x[j] - x[i])[valid])
+    return slope, np.median(y - slope*x)
+
+def track_shifts(window_scores, max_step):
+    """
+    Dynamic programming search for the path of shift indices maximizing the
+    sum of window scores when the shift may change by at most max_step
+    between consecutive windows
+    """
+    totals = np.empty(window_scores.shape)
+    totals[0, :] = window_scores[0, :]
+    for i in range(1, len(totals)):
+        totals[i, :] = window_scores[i, :] + sliding_max(totals[i-1, :], max_step)
+
+    path = np.zeros(len(totals), dtype=int)
+    path[-1] = np.argmax(totals[-1, :])
+    for i in range(len(totals)-1, 0, -1):
+        lo = max(path[i] - max_step, 0)
+        path[i-1] = lo + np.argmax(totals[i-1, lo:(path[i] + max_step + 1)])
+    return path
+
+def estimate_drift(y_subs, y_probs, max_shift_secs=20.0, max_skew_deviation=0.05, window_secs=30.0, min_label_fraction=0.1):
+    """
+    Estimate an arbitrary skew by finding the best local shifts in windows
+    along the file and fitting a robust line through them: the local shift
+    at subtitle time t is (skew - 1) * t + shift.
+
+    Returns:
+        tuple (skew, shift, residual), where shift is the intercept of the
+        line in seconds and residual is the median absolute deviation of the
+        local shifts from the line in seconds
+    """
+    labels = np.asarray(y_subs, dtype=float) == 1
+    values = score_values(y_probs)
+
+    max_shift = int((max_shift_secs + max_skew_deviation*len(labels)*frame_secs) / frame_secs)
+    shifts = range(-max_shift, max_shift+1)
+    window = max(int(window_secs / frame_secs), 1)
+    bounds = [(b, min(b + window, len(labels))) for b in range(0, len(labels), window)]
+    used = np.array([np.sum(labels[b:e]) >= min_label_fraction*window for b, e in bounds])
+    if np.sum(used) < 2:
+        return 1.0, 0.0, np.inf
+
+    # the local best shifts are found as a path with a bounded rate of
+    # change, which is much more robust than independent local maxima
+    scores = window_correlations(labels, values, bounds, shifts)
+    max_step = int(np.ceil(max_skew_deviation * window))
+    path = track_shifts(scores, max_step)
+
+    local_shifts = ((path + shifts.start) * frame_secs)[used]
+    centers = np.array([(b + e) * 0.5 for b, e in bounds])[used] * frame_secs
+
+    slope, shift = theil_sen(centers, local_shifts)
+    residual = np.median(np.abs(local_shifts - (slope*centers + shift)))
+    return 1.0 + slope, shift, residual
 
 def get_skew_pairs(frame_rates, fixed_skew=None):
     if fixed_skew is not None:
@@ -55,31 +225,114 @@ def get_skew_pairs(frame_rates, fixed_skew=None):
     uniq_idx = np.unique(skews, return_index=True)[1]
     return skews[uniq_idx], ['%g/%g' % (skew_pairs[i,0], skew_pairs[i,1]) for i in uniq_idx]
 
-def find_transform_parameters(y_subs, y_probs, max_shift_secs=20.0, frame_rates=[23.976, 24, 25], bias=0, fixed_skew=None, verbose=False, parallelism=3):
+def downsample_frames(vec, factor):
+    "Average each group of factor consecutive frames, dropping the partial tail"
+    vec = np.asarray(vec, dtype=float)
+    n = len(vec) // factor
+    return np.mean(np.reshape(vec[:(n*factor)], (n, factor)), axis=1)
+
+def find_peaks(scores, n_peaks, min_distance):
+    "Indices of the n_peaks highest local maxima at least min_distance apart"
+    scores = np.asarray(scores)
+    is_peak = np.ones(len(scores), dtype=bool)
+    is_peak[1:] &= scores[1:] >= scores[:-1]
+    is_peak[:-1] &= scores[:-1] >= scores[1:]
+    peaks = []
+    for idx in np.flatnonzero(is_peak)[np.argsort(-scores[is_peak], kind='stable')]:
+        if all(abs(idx - other) >= min_distance for other in peaks):
+            peaks.append(idx)
+            if len(peaks) == n_peaks: break
+    return peaks
+
+def coarse_search(y_subs, y_probs, skews, coarse_shift_secs, coarse_frame_secs=0.5, top_k=3, min_distance_secs=20.0):
+    """
+    Find candidate (skew, shift) pairs over a wide shift range using
+    downsampled labels and speech probabilities.
+
+    Returns:
+        list of the top_k (score, skew index, shift in seconds) tuples,
+        in decreasing order of score
+    """
+    factor = max(int(round(coarse_frame_secs / frame_secs)), 1)
+    coarse_secs = factor * frame_secs
+    coarse_subs = np.round(downsample_frames(y_subs, factor))
+    coarse_probs = downsample_frames(y_probs, factor)
+
+    max_shift = int(coarse_shift_secs / coarse_secs)
+    shifts = range(-max_shift, max_shift+1)
+    min_distance = max(int(min_distance_secs / coarse_secs), 1)
+
+    candidates = []
+    for skew_idx, skew in enumerate(skews):
+        scores = shift_score_curve(coarse_subs, coarse_probs, shifts, skew)
+        for idx in find_peaks(scores, top_k, min_distance):
+            candidates.append((scores[idx], skew_idx, shifts[idx]*coarse_secs))
+
+    candidates.sort(key=lambda c: -c[0])
+    return candidates[:top_k]
+
+def find_transform_parameters(y_subs, y_probs, max_shift_secs=20.0, frame_rates=[23.976, 24, 25], bias=0, fixed_skew=None, verbose=False, parallelism=3, coarse_shift_secs=None, coarse_frame_secs=0.5, coarse_top_k=3, estimate_skew=False, executor=None, profiler=None):
+    profiler = profiling.get(profiler)
+    base_shift = 0.0
+    if estimate_skew and fixed_skew is None:
+        # replace the grid of skews by a single estimated one and
+        # refine around the estimated shift
+        with profiler.stage('skew_estimation'):
+            fixed_skew, base_shift, residual = estimate_drift(y_subs, y_probs, \
+                max_shift_secs=max(max_shift_secs, coarse_shift_secs or 0))
+        # recorded so that callers can reject a bad drift fit, None (valid
+        # JSON unlike inf) if the drift could not be fitted
+        profiler.set('skew_fit_residual_secs', \
+            float(residual) if np.isfinite(residual) else None)
+        base_shift = np.round(base_shift / frame_secs) * frame_secs
+        coarse_shift_secs = None
+        if verbose:
+            print('estimated skew %g, shift %gs, fit residual %gs' % \
+                (fixed_skew, base_shift, residual))
+
     skews, skew_labels = get_skew_pairs(frame_rates, fixed_skew=fixed_skew)
     if verbose:
         print('max shift %gs, test increments %gs' % (max_shift_secs, frame_secs))
         print('testing with skews: ' + ', '.join(skew_labels))
         print('bias', bias)
 
-    shift_score_quality = np.array(maybe_parallel_map( \
-        _best_shift_star, \
-        [(y_subs, y_probs, max_shift_secs, skew) for skew in skews], \
-        parallelism))
+    if coarse_shift_secs is None:
+        candidates = [(skew_idx, base_shift) for skew_idx in range(len(skews))]
+    else:
+        # coarse-to-fine: only refine around the best coarse peaks
+        if verbose:
+            print('coarse search: max shift %gs, test increments %gs, top %d' % \
+                (coarse_shift_secs, coarse_frame_secs, coarse_top_k))
+        with profiler.stage('coarse_search'):
+            candidates = [(skew_idx, base_shift) for _, skew_idx, base_shift in \
+                coarse_search(y_subs, y_probs, skews, coarse_shift_secs, \
+                    coarse_frame_secs, coarse_top_k, min_distance_secs=max_shift_secs)]
+
+    profiler.set('skews_tried', len(skews))
+    profiler.set('shift_searches', len(candidates))
+
+    # share the data with worker processes instead of pickling it per task
+    with sharedmem.SharedArrays(sharedmem.uses_processes(parallelism, executor)) as shared:
+        y_subs_shared, y_probs_shared = shared.share(y_subs), shared.share(y_probs)
+        shift_score_quality = np.array(maybe_parallel_map( \
+            _best_shift_star, \
+            [(y_subs_shared, y_probs_shared, max_shift_secs, skews[skew_idx], base_shift) \
+                for skew_idx, base_shift in candidates], \
+            parallelism, executor))
 
     if verbose:
         print('shift\tscore\tquality\tskew')
         for i in range(len(shift_score_quality)):
-            print('\t'.join(["%.3g" % s for s in shift_score_quality[i]]) + '\t' + skew_labels[i])
+            print('\t'.join(["%.3g" % s for s in shift_score_quality[i]]) + '\t' + skew_labels[candidates[i][0]])
 
     best_idx = np.argmax(shift_score_quality[:,1])
 
     shift = shift_score_quality[best_idx,0] + bias
-    skew = skews[best_idx]
+    skew = skews[candidates[best_idx][0]]
     quality = shift_score_quality[best_idx,2]
 
     if verbose:
-        skew_label = skew_labels[best_idx]
+        skew_label = skew_labels[candidates[best_idx][0]]
         print('optimal shift: %g seconds, skew: %s' % (shift, skew_label))
 
     return skew, shift, quality
@@ -1,35 +1,335 @@
 #!/usr/bin/python3
-import argparse
-import numpy as np
-import gc
+import contextlib
 import os
 import sys
 
 def parse_skew(skew):
-    "helper function, parse maybe fractional notation like 24/24 to float"
+    "helper function, parse a number or maybe fractional notation like 24/24 to float"
     if skew is None: return None
+    if isinstance(skew, (int, float)): return float(skew)
     if '/' in skew:
         a, b = [float(x) for x in skew.split('/')]
         return a / b
     else:
         return float(skew)
 
+def _detect_speech(video_file, trained_model, sample_rate, parallelism, verbose, \
+    executor=None, fft_workers=None, profiler=None, subtitle_streams=()):
+    """
+    Speech probabilities for all frames of the video. The embedded
+    subtitle_streams are extracted in the same ffmpeg pass
+    """
+    import numpy as np
+    from autosubsync import features
+    from autosubsync import model
+    from autosubsync import preprocessing
+    from autosubsync import profiling
+
+    profiler = profiling.get(profiler)
+
+    if verbose: print(('Extracting audio using ffmpeg, computing features and ' + \
+        'detecting speech in %d-second chunks using %d parallel process(es)') % \
+        (features.chunk_size_secs, parallelism))
+
+    # stream: ffmpeg audio blocks -> feature chunks -> speech probabilities,
+    # so that memory use does not depend on the length of the video
+    frame_size = int(features.frame_secs*sample_rate)
+    sound_blocks = profiler.iterate('decode', preprocessing.stream_sound(video_file, \
+        features.chunk_size_samples(frame_size), sample_rate=sample_rate, \
+        subtitle_streams=subtitle_streams), counter='chunks')
+    feature_chunks = profiler.iterate('features', features.compute_stream(sound_blocks, \
+        sample_rate, data_range=2**15, parallelism=parallelism, executor=executor, \
+        fft_workers=fft_workers))
+    return np.hstack(list(profiler.iterate('predict', \
+        model.predict_stream(trained_model, feature_chunks))))
+
+def _detect_speech_sampled(video_file, trained_model, n_segments, segment_secs, \
+    sample_rate, parallelism, verbose, executor=None, fft_workers=None, profiler=None, \
+    subtitle_streams=()):
+    """
+    Speech probabilities for evenly spaced segments of the video, decoded
+    concurrently by seeking ffmpeg processes. Other frames are NaN. The
+    embedded subtitle_streams are extracted by another ffmpeg process
+    """
+    from multiprocessing.pool import ThreadPool
+    import numpy as np
+    from autosubsync import features
+    from autosubsync import model
+    from autosubsync import preprocessing
+    from autosubsync import profiling
+
+    profiler = profiling.get(profiler)
+
+    with profiler.stage('probe'):
+        duration = preprocessing.probe_duration(video_file)
+    if duration is None or n_segments*segment_secs >= duration:
+        if verbose: print('cannot sample segments (duration %s), analyzing all audio' % duration)
+        return _detect_speech(video_file, trained_model, sample_rate, \
+            parallelism, verbose, executor, fft_workers, profiler, subtitle_streams)
+
+    frame_secs = features.frame_secs
+    n_frames = int(duration / frame_secs)
+    segment_frames = int(segment_secs / frame_secs)
+    starts = [int(round((i + 0.5)*n_frames/float(n_segments) - segment_frames*0.5)) \
+        for i in range(n_segments)]
+
+    if verbose: print(('Extracting %d segments of %gs using ffmpeg and ' + \
+        'detecting speech using %d parallel process(es)') % \
+        (n_segments, segment_secs, parallelism))
+
+    def decode(start):
+        return preprocessing.decode_sound(video_file, sample_rate, \
+            start_secs=start*frame_secs, duration_secs=segment_frames*frame_secs)[0]
+
+    with profiler.stage('decode'):
+        # at most parallelism ffmpeg processes at a time
+        pool = ThreadPool(min(n_segments, max(parallelism, 1)))
+        try:
+            sound_blocks = pool.map(decode, starts)
+        finally:
+            pool.close()
+            pool.join()
+        if subtitle_streams: preprocessing.extract_subtitles(video_file, subtitle_streams)
+    profiler.set('chunks', len(sound_blocks))
+
+    y_scores = np.full(n_frames, np.nan)
+    feature_chunks = profiler.iterate('features', features.compute_stream(sound_blocks, \
+        sample_rate, data_range=2**15, parallelism=parallelism, executor=executor, \
+        fft_workers=fft_workers))
+    for start, chunk_x in zip(starts, feature_chunks):
+        with profiler.stage('predict'):
+            probs = model.predict(trained_model, chunk_x)[:(n_frames - start)]
+        y_scores[start:(start + len(probs))] = probs
+
+    analyzed_fraction = float(np.mean(~np.isnan(y_scores)))
+    profiler.set('analyzed_fraction', analyzed_fraction)
+    if verbose:
+        print('analyzed %.1f%% of the audio' % (100.0*analyzed_fraction))
+    return y_scores
+
+def packaged_model_file():
+    """
+    Path of the model file distributed with the package (see setup.py).
+    The same path pkg_resources.resource_filename would return, without
+    the (slow) import of pkg_resources
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+        os.pardir, 'trained-model.bin')
+
+def _load_model(model_file):
+    from autosubsync import model
+    if model_file is None: model_file = packaged_model_file()
+    return model.load(model_file)
+
+def _speech_cache_key(speech_cache, video_file, trained_model, sample_rate, \
+    sampled_segments=None, sampled_segment_secs=90.0):
+    "Cache key of the speech detection results of a video, see cache.SpeechCache"
+    from autosubsync import features
+    return speech_cache.key(video_file, trained_model, {
+        'sample_rate': sample_rate,
+        'frame_secs': features.frame_secs,
+        'chunk_size_secs': features.chunk_size_secs,
+        'sampled_segments': sampled_segments,
+        'sampled_segment_secs': sampled_segment_secs
+    })
+
+def detect_speech(video_file, trained_model, verbose=False, parallelism=3, \
+    sample_rate=20000, sampled_segments=None, sampled_segment_secs=90.0, \
+    cache_dir=None, cache_max_bytes=2**30, executor=None, fft_workers=None, \
+    profiler=None, subtitle_streams=()):
+    """
+    Speech probability of each frame of the audio in a video file, possibly
+    read from / stored to a cache. See synchronize for the arguments.
+
+    Also converts the embedded subtitle streams given as a list of tuples
+    (stream, srt_file) to SRT files (see preprocessing.subtitle_output_args),
+    in the same ffmpeg pass as the audio unless sampling segments or the
+    speech was found in the cache
+    """
+    from autosubsync import profiling
+
+    profiler = profiling.get(profiler)
+    y_scores = None
+    if cache_dir is not None:
+        from autosubsync import cache
+        speech_cache = cache.SpeechCache(cache_dir, cache_max_bytes)
+        with profiler.stage('cache'):
+            cache_key = _speech_cache_key(speech_cache, video_file, trained_model, \
+                sample_rate, sampled_segments, sampled_segment_secs)
+            y_scores = speech_cache.get(cache_key)
+        profiler.set('cache_hit', y_scores is not None)
+        if verbose:
+            print('speech detection cache %s (%s)' % \
+                ('miss' if y_scores is None else 'hit', cache_key[:16]))
+
+    if y_scores is None:
+        if sampled_segments is None:
+            y_scores = _detect_speech(video_file, trained_model, sample_rate, \
+                parallelism, verbose, executor, fft_workers, profiler, subtitle_streams)
+        else:
+            y_scores = _detect_speech_sampled(video_file, trained_model, \
+                sampled_segments, sampled_segment_secs, sample_rate, parallelism, \
+                verbose, executor, fft_workers, profiler, subtitle_streams)
+
+        if cache_dir is not None:
+            with profiler.stage('cache'):
+                y_scores = speech_cache.put(cache_key, y_scores)
+    elif subtitle_streams:
+        from autosubsync import preprocessing
+        with profiler.stage('decode'):
+            preprocessing.extract_subtitles(video_file, subtitle_streams)
+
+    profiler.set('frames', len(y_scores))
+    return y_scores
+
+def _sync_subtitles(subtitle_file, output_file, y_scores, bias, verbose=False, \
+    parallelism=3, fixed_skew=None, segmented=False, max_segment_shift_secs=300.0, \
+    sample_rate=20000, profiler=None, **kwargs):
+    """
+    Find the best transform of one subtitle file (a file name or an
+    srt_io.SrtData read from it) given the detected speech and write the
+    transformed subtitles
+
+    Returns:
+        a tuple (success, quality, skew, shift, segments), where segments
+        is None if not in segmented mode
+    """
+    from autosubsync import features
+    from autosubsync import find_transform
+    from autosubsync import piecewise
+    from autosubsync import preprocessing
+    from autosubsync import profiling
+    from autosubsync import quality_of_fit
+    from autosubsync import sharedmem
+
+    profiler = profiling.get(profiler)
+    y_scores = sharedmem.attach(y_scores)
+    frame_size = int(features.frame_secs*sample_rate)
+    if verbose: print('detected speech in %d frames, reading subtitles' % len(y_scores))
+    with profiler.stage('subtitles'):
+        shifted_y = preprocessing.import_subs_frames(subtitle_file, sample_rate, \
+            frame_size, len(y_scores))
+
+    if verbose:
+        print('computing best fit with %d frames' % len(y_scores))
+
+    with profiler.stage('search'):
+        skew, shift, quality = find_transform.find_transform_parameters(\
+            shifted_y, y_scores, \
+            parallelism=parallelism, fixed_skew=parse_skew(fixed_skew), bias=bias, \
+            verbose=verbose, profiler=profiler, **kwargs)
+
+    segments = None
+    if segmented:
+        with profiler.stage('segmentation'):
+            segments = piecewise.find_segments(shifted_y, y_scores, skew, shift, \
+                bias=bias, max_shift_secs=max_segment_shift_secs, verbose=verbose)
+        profiler.set('segments', len(segments))
+        quality = min([s['quality'] for s in segments])
+        shift = max(segments, key=lambda s: s['end'] - s['begin'])['shift']
+        transform_func = piecewise.segments_to_transform(skew, segments)
+    else:
+        transform_func = find_transform.parameters_to_transform(skew, shift)
+
+    success = quality > quality_of_fit.threshold
+    if verbose:
+        print('quality of fit: %g, threshold %g' % (quality, quality_of_fit.threshold))
+        print('Fit complete. Performing resync, writing to ' + output_file)
+
+    with profiler.stage('write'):
+        preprocessing.transform_srt(subtitle_file, output_file, transform_func)
+
+    if verbose and success: print('success!')
+
+    return success, quality, skew, shift, segments
+
+@contextlib.contextmanager
+def _maybe_executor(executor, parallelism, backend):
+    "Use the given executor or a temporary one for the duration of the block"
+    from autosubsync import features
+    if executor is not None or parallelism <= 1:
+        yield executor
+    else:
+        with features.Executor(parallelism, backend) as executor:
+            yield executor
+
+@contextlib.contextmanager
+def _extracted_subtitles(subtitle_streams):
+    """
+    Temporary SRT file names for the embedded subtitle streams, as a list
+    of tuples (stream, srt_file). The files are removed after the block
+    """
+    import shutil
+    import tempfile
+    if not subtitle_streams:
+        yield []
+        return
+    temp_dir = tempfile.mkdtemp(prefix='autosubsync-')
+    try:
+        yield [(stream, os.path.join(temp_dir, 'stream-%d.srt' % i)) \
+            for i, stream in enumerate(subtitle_streams)]
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _n_workers(executor, parallelism):
+    return executor.parallelism if executor is not None else max(parallelism, 1)
+
+def _sync_subtitles_star(args):
+    args, kwargs = args
+    return _sync_subtitles(*args, **kwargs)
+
+def _format_result(result, segmented, return_parameters):
+    if return_parameters:
+        if segmented: return result
+        return result[:4]
+    else:
+        return result[0]
+
 def synchronize(video_file, subtitle_file, output_file, verbose=False, \
     parallelism=3, fixed_skew=None, model_file=None, return_parameters=False, \
-    **kwargs):
+    subtitle_stream=None, **kwargs):
     """
     Automatically synchronize subtitles with audio in a video file.
     Uses FFMPEG to extract the audio from the video file and the command line
-    tool "ffmpeg" must be available. Uses temporary files which are deleted
-    automatically.
+    tool "ffmpeg" must be available. The audio is read directly from the
+    output of ffmpeg without temporary files.
 
     Args:
         video_file (string): Input video file name
-        subtitle_file (string): Input SRT subtitle file name
+        subtitle_file (string): Input SRT subtitle file name, None if
+            subtitle_stream is given
         output_file (string): Output (synchronized) SRT subtitle file name
         verbose (boolean): If True, print progress information to stdout
         return_parameters (boolean): If True, returns the syncrhonization
             parameters instead of just the success flag
+        segmented (boolean): If True, allow a different shift for each
+            segment of the video, e.g., if ad breaks have been removed
+        max_segment_shift_secs (float): In segmented mode, maximum shift
+            of a segment relative to the best global shift
+        sample_rate (int): Sample rate (Hz) the audio is resampled to for
+            speech detection. Should match the rate used in training
+        sampled_segments (int): If given, only decode and analyze this many
+            evenly spaced segments of the audio (quick sync)
+        sampled_segment_secs (float): Length of each sampled segment
+        cache_dir (string): If given, cache speech detection results in this
+            directory and reuse them for the same video, model and settings
+        cache_max_bytes (int): Maximum size of the cache directory
+        executor (features.Executor): If given, run all parallel work in
+            this long-lived executor instead of a temporary one, which is
+            useful when synchronizing many files in the same process
+        parallel_backend (string): Backend of the temporary executor
+            ('process', 'thread', 'fork', 'forkserver' or 'spawn')
+        fft_workers (int): Number of threads used by each FFT if scipy is
+            installed (default features.fft_workers, -1 for all cores)
+        profiler (profiling.Profiler): If given, collect the wall and CPU
+            time of each stage and counters such as the number of frames
+            and skews tried, see profiling.Profiler.report
+        trained_model (tuple): If given, use this already loaded model (see
+            model.load) instead of loading model_file
+        subtitle_stream (string): If given, synchronize this subtitle stream
+            embedded in the video file instead of subtitle_file, e.g., 's:0'
+            for the first subtitle stream. It is extracted by the same ffmpeg
+            process as the audio
         other arguments: Search parameters, see ``autosubsync --help``
 
     Returns:
@@ -43,103 +343,237 @@ def synchronize(video_file, subtitle_file, output_file, verbose=False, \
             skew (float)        best fit skew/speed (unitless)
             shift (float)       best fit shift in seconds
 
-    """
-
-    # these are here to enable running as python3 autosubsync/main.py
-    from autosubsync import features
-    from autosubsync import find_transform
-    from autosubsync import model
-    from autosubsync import preprocessing
-    from autosubsync import quality_of_fit
-    from autosubsync import srt_io
-
-    # first check that the SRT file is valid before extracting any audio data
-    srt_io.check_file(subtitle_file)
-
-    # argument parsing
-    if model_file is None:
-        from pkg_resources import resource_filename
-        model_file = resource_filename(__name__, '../trained-model.bin')
-
-    fixed_skew = parse_skew(fixed_skew)
+        In segmented mode, the tuple has a fifth element, a list of segments
+        as dicts with the keys 'begin', 'end' (in input subtitle time),
+        'shift' and 'quality'. The overall quality is the lowest segment
+        quality and shift is that of the longest segment.
 
-    # load model
-    trained_model = model.load(model_file)
-
-    if verbose: print('Extracting audio using ffmpeg and reading subtitles...')
-    sound_data, subvec = preprocessing.import_target_files(video_file, subtitle_file)
-
-    if verbose: print(('computing features for %d audio samples ' + \
-        'using %d parallel process(es)') % (len(subvec), parallelism))
-
-    features_x, shifted_y = features.compute(sound_data, subvec, parallelism=parallelism)
-
-    if verbose: print('extracted features of size %s, performing speech detection' % \
-        str(features_x.shape))
-
-    y_scores = model.predict(trained_model, features_x)
-
-    # save some memory before parallelization fork so we look less bad
-    del features_x, sound_data, subvec
-    gc.collect()
-
-    if verbose:
-        print('computing best fit with %d frames' % len(y_scores))
-
-    skew, shift, quality = find_transform.find_transform_parameters(\
-        shifted_y, y_scores, \
-        parallelism=parallelism, fixed_skew=fixed_skew, bias=trained_model[1], \
-        verbose=verbose, **kwargs)
-
-    success = quality > quality_of_fit.threshold
-    if verbose:
-        print('quality of fit: %g, threshold %g' % (quality, quality_of_fit.threshold))
-        print('Fit complete. Performing resync, writing to ' + output_file)
+    """
 
-    transform_func = find_transform.parameters_to_transform(skew, shift)
-    preprocessing.transform_srt(subtitle_file, output_file, transform_func)
+    if (subtitle_file is None) == (subtitle_stream is None):
+        raise ValueError('expected either a subtitle file or a subtitle stream')
 
-    if verbose and success: print('success!')
-
-    if return_parameters:
-        return success, quality, skew, shift
+    if subtitle_stream is None:
+        subtitle_files, subtitle_streams = [subtitle_file], []
     else:
-        return success
+        subtitle_files, subtitle_streams = [], [subtitle_stream]
+
+    return synchronize_many(video_file, subtitle_files, [output_file], \
+        verbose=verbose, parallelism=parallelism, fixed_skew=fixed_skew, \
+        model_file=model_file, return_parameters=return_parameters, \
+        subtitle_streams=subtitle_streams, **kwargs)[0]
+
+def synchronize_many(video_file, subtitle_files, output_files, verbose=False, \
+    parallelism=3, model_file=None, return_parameters=False, segmented=False, \
+    sample_rate=20000, sampled_segments=None, sampled_segment_secs=90.0, \
+    cache_dir=None, cache_max_bytes=2**30, executor=None, \
+    parallel_backend='process', fft_workers=None, profiler=None, \
+    trained_model=None, subtitle_streams=None, **kwargs):
+    """
+    Synchronize several subtitle files (e.g., different languages) with the
+    same video file. The audio is extracted and speech is detected only once
+    and the subtitle files are then synchronized in parallel.
 
-def cli(packaged_model=False):
-    p = argparse.ArgumentParser(description=synchronize.__doc__.split('\n\n')[0])
-    p.add_argument('video_file', help='Input video file')
-    p.add_argument('subtitle_file', help='Input SRT subtitle file')
-    p.add_argument('output_file', help='Output (auto-synchronized) SRT subtitle file')
+    Args:
+        video_file (string): Input video file name
+        subtitle_files (list): Input SRT subtitle file names
+        output_files (list): Output SRT subtitle file names, one for each
+            input subtitle file followed by one for each subtitle stream
+        parallelism (int): Number of parallel workers, used for speech
+            detection and then for synchronizing one subtitle file each
+        subtitle_streams (list): Subtitle streams embedded in the video file
+            to synchronize too, e.g., ['s:0', 's:1']. They are extracted by
+            the same ffmpeg process as the audio
+        other arguments: as in synchronize
 
+    Returns:
+        A list with one element per subtitle file and stream, each the same
+        as the return value of synchronize
+    """
+    from autosubsync import features
+    from autosubsync import profiling
+    from autosubsync import sharedmem
+    from autosubsync import srt_io
+
+    subtitle_streams = list(subtitle_streams or [])
+    if len(subtitle_files) + len(subtitle_streams) != len(output_files):
+        raise ValueError('expected as many output files as subtitle files and streams')
+
+    subtitles = [srt_io.check_file(subtitle_file) for subtitle_file in subtitle_files]
+
+    profiler = profiling.get(profiler)
+    profiler.set('subtitle_files', len(output_files))
+    if trained_model is None:
+        with profiler.stage('load_model'):
+            trained_model = _load_model(model_file)
+
+    with _maybe_executor(executor, parallelism, parallel_backend) as executor, \
+        _extracted_subtitles(subtitle_streams) as extracted:
+        profiler.set('workers', _n_workers(executor, parallelism))
+        y_scores = detect_speech(video_file, trained_model, verbose=verbose, \
+            parallelism=parallelism, sample_rate=sample_rate, \
+            sampled_segments=sampled_segments, sampled_segment_secs=sampled_segment_secs, \
+            cache_dir=cache_dir, cache_max_bytes=cache_max_bytes, executor=executor, \
+            fft_workers=fft_workers, profiler=profiler, subtitle_streams=extracted)
+        subtitles += [srt_io.check_file(srt_file) for _, srt_file in extracted]
+
+        sync_kwargs = dict(kwargs, segmented=segmented, sample_rate=sample_rate)
+        if len(subtitles) == 1 or parallelism <= 1:
+            results = [_sync_subtitles(sub, out, y_scores, trained_model[1], \
+                verbose=verbose, parallelism=parallelism, executor=executor, \
+                profiler=profiler, **sync_kwargs) \
+                for sub, out in zip(subtitles, output_files)]
+        else:
+            # parallelize over subtitle files instead of the skew candidates
+            if verbose:
+                print('synchronizing %d subtitle files using %d parallel workers' % \
+                    (len(subtitles), parallelism))
+            sync_kwargs.update(verbose=False, parallelism=1)
+            with sharedmem.SharedArrays(sharedmem.uses_processes(parallelism, executor)) as shared:
+                y_scores_shared = shared.share(y_scores)
+                jobs = [((sub, out, y_scores_shared, trained_model[1]), sync_kwargs) \
+                    for sub, out in zip(subtitles, output_files)]
+                # the stages of each file are not profiled separately
+                with profiler.stage('fit_subtitle_files'):
+                    results = features.maybe_parallel_map(_sync_subtitles_star, jobs, \
+                        parallelism, executor)
+
+    if verbose and len(results) > 1:
+        for out, (success, quality, skew, shift, _) in zip(output_files, results):
+            print('%s: quality of fit %g, skew %g, shift %g seconds%s' % \
+                (out, quality, skew, shift, '' if success else ' (FAILED)'))
+
+    return [_format_result(r, segmented, return_parameters) for r in results]
+
+def add_sync_arguments(p, packaged_model):
+    "Add the command line arguments shared by all commands to an ArgumentParser"
     # Make model file an argument only in the non-packaged version
     if not packaged_model:
         p.add_argument('--model_file', default='trained-model.bin')
 
     p.add_argument('--max_shift_secs', default=20.0, type=float,
         help='Maximum subtitle shift in seconds (default 20)')
+    p.add_argument('--coarse_shift_secs', default=None, type=float,
+        help='Search shifts up to this many seconds (e.g. 600) with a ' + \
+            'coarse-to-fine search, refining around the best coarse matches')
     p.add_argument('--parallelism', default=3, type=int,
         help='Number of parallel worker processes (default 3)')
+    p.add_argument('--parallel_backend', default='process',
+        choices=['process', 'thread', 'fork', 'forkserver', 'spawn'],
+        help='Run parallel work in processes (default) or threads')
+    p.add_argument('--fft_workers', default=None, type=int,
+        help='Number of threads used by each FFT if scipy is installed ' + \
+            '(default 1, -1 for all cores)')
     p.add_argument('--fixed_skew', default=None,
         help='Use a fixed skew (e.g. 1) instead of auto-detection')
+    p.add_argument('--segmented', action='store_true',
+        help='Allow a different shift for each segment of the video, ' + \
+            'e.g., if ad breaks or scenes have been removed')
+    p.add_argument('--max_segment_shift_secs', default=300.0, type=float,
+        help='Maximum shift of a segment relative to the global shift ' + \
+            'in segmented mode (default 300)')
+    p.add_argument('--estimate_skew', action='store_true',
+        help='Estimate an arbitrary skew from local shifts along the file ' + \
+            'instead of testing common frame rate ratios')
+    p.add_argument('--sampled_segments', default=None, type=int,
+        help='Quick sync: only analyze this many evenly spaced segments ' + \
+            'of the audio (e.g. 8)')
+    p.add_argument('--sampled_segment_secs', default=90.0, type=float,
+        help='Length of each sampled segment in seconds (default 90)')
+    p.add_argument('--cache_dir', default=None,
+        help='Cache speech detection results in this directory, e.g., ' + \
+            'to sync many subtitle files with the same video faster')
+    p.add_argument('--cache_max_mb', default=1024, type=float,
+        help='Maximum size of the cache directory in megabytes (default 1024)')
     p.add_argument('--silent', action='store_true',
         help='Do not print progress information')
-    args = p.parse_args()
 
-    if packaged_model:
-        model_file = None
-    else:
-        model_file = args.model_file
+def sync_arguments(args, packaged_model):
+    "Keyword arguments to synchronize from parsed add_sync_arguments arguments"
+    return dict(
+        model_file = None if packaged_model else args.model_file,
+        max_shift_secs = args.max_shift_secs,
+        coarse_shift_secs = args.coarse_shift_secs,
+        parallelism = args.parallelism,
+        fixed_skew = args.fixed_skew,
+        estimate_skew = args.estimate_skew,
+        sampled_segments = args.sampled_segments,
+        sampled_segment_secs = args.sampled_segment_secs,
+        cache_dir = args.cache_dir,
+        cache_max_bytes = int(args.cache_max_mb * 2**20),
+        parallel_backend = args.parallel_backend,
+        fft_workers = args.fft_workers,
+        segmented = args.segmented,
+        max_segment_shift_secs = args.max_segment_shift_secs)
 
-    success = synchronize(args.video_file, args.subtitle_file, args.output_file,\
-                  verbose = not args.silent,
-                  model_file = model_file,
-                  max_shift_secs = args.max_shift_secs, \
-                  parallelism = args.parallelism,
-                  fixed_skew = args.fixed_skew)
+def cli(packaged_model=False):
+    import argparse
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from autosubsync import batch
+        return batch.cli(packaged_model, sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from autosubsync import server
+        return server.cli(packaged_model, sys.argv[2:])
+
+    p = argparse.ArgumentParser(description=synchronize.__doc__.split('\n\n')[0])
+    p.add_argument('video_file', help='Input video file')
+    p.add_argument('subtitle_file', nargs='?', help='Input SRT subtitle file')
+    p.add_argument('output_file', nargs='?', help='Output (auto-synchronized) SRT subtitle file')
+    p.add_argument('more_files', nargs='*', metavar='SUBTITLE_FILE OUTPUT_FILE',
+        help='More pairs of input and output subtitle files to synchronize ' + \
+            'with the same video. Speech is detected only once')
+    p.add_argument('--subtitle_stream', '--subtitle-stream', nargs=2, action='append',
+        default=[], metavar=('STREAM', 'OUTPUT_FILE'),
+        help='Synchronize a subtitle stream embedded in the video file, ' + \
+            'e.g., s:0 for the first one, instead of or in addition to ' + \
+            'subtitle files. Extracted in the same pass as the audio')
+
+    add_sync_arguments(p, packaged_model)
+    p.add_argument('--timings_json', '--timings-json', default=None, metavar='PATH',
+        help='Write the time spent in each stage and other statistics ' + \
+            'to this JSON file')
+    p.add_argument('--memory_profile', '--memory-profile', action='store_true',
+        help='Also record the peak memory use of each stage in the ' + \
+            '--timings_json report (slower)')
+    args = p.parse_args()
 
-    if not success:
-        sys.stderr.write("\nWARNING: low quality of fit. Wrong subtitle file?\n")
+    files = [f for f in [args.subtitle_file, args.output_file] if f is not None] + \
+        args.more_files
+    if len(files) % 2 != 0:
+        p.error('expected pairs of subtitle and output files')
+    if not files and not args.subtitle_stream:
+        p.error('expected a subtitle file and an output file or --subtitle_stream')
+    subtitle_streams = [stream for stream, _ in args.subtitle_stream]
+    subtitle_files = files[0::2]
+    output_files = files[1::2] + [out for _, out in args.subtitle_stream]
+
+    if args.memory_profile and args.timings_json is None:
+        p.error('--memory_profile requires --timings_json')
+
+    profiler = None
+    if args.timings_json is not None:
+        from autosubsync import profiling
+        profiler = profiling.Profiler(memory=args.memory_profile)
+
+    results = synchronize_many(args.video_file, subtitle_files, output_files, \
+        verbose=not args.silent, profiler=profiler, subtitle_streams=subtitle_streams, \
+        **sync_arguments(args, packaged_model))
+
+    if profiler is not None:
+        import json
+        profiler.close()
+        with open(args.timings_json, 'w') as f:
+            json.dump(profiler.report(), f, indent=2, sort_keys=True)
+
+    inputs = subtitle_files + subtitle_streams
+    failed = [f for f, success in zip(inputs, results) if not success]
+    if failed:
+        if len(inputs) > 1:
+            sys.stderr.write("\nWARNING: low quality of fit for %s. Wrong subtitle file?\n" % \
+                ', '.join(failed))
+        else:
+            sys.stderr.write("\nWARNING: low quality of fit. Wrong subtitle file?\n")
         sys.exit(1)
 
 def cli_packaged():
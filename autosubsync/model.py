@@ -1,8 +1,13 @@
 import numpy as np
 import json
+import os
+import struct
 from . import features
 from .trained_logistic_regression import TrainedLogisticRegression
 
+# number of neighbouring frames on each side used by transform
+transform_context = 5
+
 def transform(data_x):
     return np.hstack([
         features.expand_to_adjacent(data_x, width=1),
@@ -10,6 +15,27 @@ def transform(data_x):
         features.rolling_aggregates(data_x, width=5, aggregate=np.max)
     ])
 
+def transform_dot(data_x, coefficients):
+    """
+    Same as np.dot(transform(data_x), coefficients) without building the
+    transformed matrix: the adjacent frames part is linear and can be
+    computed as shifted weighted sums and the rolling maxima are computed
+    with an O(n) sliding window algorithm
+    """
+    n_features = data_x.shape[1]
+    coefs = np.reshape(coefficients, (5, n_features))
+
+    # expand_to_adjacent: blocks of the frames i+1, i and i-1
+    adjacent = np.dot(data_x, coefs[:3].T)
+    result = adjacent[:, 1].copy()
+    result[:-1] += adjacent[1:, 0]
+    result[1:] += adjacent[:-1, 2]
+
+    # rolling_aggregates treat frames outside data_x as zeros
+    result += np.dot(features.sliding_max(data_x, 2, fill_value=0.0), coefs[3])
+    result += np.dot(features.sliding_max(data_x, 5, fill_value=0.0), coefs[4])
+    return result
+
 def normalize(data_x):
     return data_x
 
@@ -72,8 +98,34 @@ def train(training_x, training_y, training_meta, verbose=False):
 def predict(model, test_x, file_labels=None):
     speech_detection = model[0]
     test_x = features.normalize_by_file(test_x, normalize, file_labels)
-    test_x = transform(test_x)
-    return speech_detection.predict_proba(test_x)[:,1]
+    return speech_detection.predict_proba(test_x, transform_dot=transform_dot)[:,1]
+
+def predict_stream(model, feature_chunks):
+    """
+    Speech probabilities for a stream of consecutive feature chunks. Gives
+    the same result as predict on the stacked chunks by passing the
+    neighbouring frames of each chunk as context to transform. All chunks
+    except the last must have at least transform_context frames.
+
+    Yields:
+        speech probabilities, one vector for each chunk
+    """
+    context = transform_context
+    before = None
+    current = None
+    for chunk_x in feature_chunks:
+        if current is not None:
+            yield _predict_with_context(model, before, current, chunk_x[:context])
+            before = np.vstack([before, current])[-context:] if before is not None else current[-context:]
+        current = chunk_x
+
+    if current is not None:
+        yield _predict_with_context(model, before, current, None)
+
+def _predict_with_context(model, before, current, after):
+    parts = [p for p in [before, current, after] if p is not None]
+    begin = 0 if before is None else len(before)
+    return predict(model, np.vstack(parts))[begin:(begin + len(current))]
 
 def serialize(model):
     return json.dumps({
@@ -88,10 +140,90 @@ def deserialize(data):
         d['bias']
     ]
 
-def load(model_file):
-    with open(model_file, 'r') as f:
-        return deserialize(f.read())
-
-def save(trained_model, target_file):
-    with open(target_file, 'w') as f:
-        f.write(serialize(trained_model))
+# Binary model format: magic, header (little-endian uint32 format version,
+# uint32 number of coefficients, float64 logistic regression bias, float64
+# sync bias) and the coefficients as little-endian float64, so that they
+# can be memory-mapped as is
+binary_magic = b'ASSMODEL'
+binary_version = 1
+_binary_header = '<IIdd'
+_binary_offset = len(binary_magic) + struct.calcsize(_binary_header)
+
+def save_binary(trained_model, target_file):
+    speech_detection, bias = trained_model
+    coefficients = np.asarray(speech_detection.coefficients, dtype='<f8')
+    with open(target_file, 'wb') as f:
+        f.write(binary_magic)
+        f.write(struct.pack(_binary_header, binary_version, len(coefficients), \
+            speech_detection.bias, bias))
+        f.write(coefficients.tobytes())
+
+def load_binary(model_file):
+    "Load a binary model, memory-mapping the coefficients"
+    with open(model_file, 'rb') as f:
+        head = f.read(_binary_offset)
+    if not head.startswith(binary_magic) or len(head) < _binary_offset:
+        raise ValueError('%s is not a binary model file' % model_file)
+    version, n, lr_bias, bias = struct.unpack(_binary_header, head[len(binary_magic):])
+    if version != binary_version:
+        raise ValueError('unsupported model format version %d in %s' % (version, model_file))
+    coefficients = np.memmap(model_file, dtype='<f8', mode='r', \
+        offset=_binary_offset, shape=(n,))
+    return [TrainedLogisticRegression(coefficients, lr_bias), bias]
+
+# loaded models by file, see load
+_cache = {}
+
+def load(model_file, cache=True):
+    """
+    Load a model in the binary or (older) JSON format
+
+    Args:
+        model_file (string): model file name
+        cache (boolean): if True, reuse the model loaded from the same file
+            earlier in this process unless the file has been modified since
+    """
+    key = None
+    if cache:
+        st = os.stat(model_file)
+        key = (os.path.abspath(model_file), st.st_mtime_ns, st.st_size)
+        if key in _cache: return list(_cache[key])
+
+    with open(model_file, 'rb') as f:
+        binary = f.read(len(binary_magic)) == binary_magic
+    if binary:
+        trained_model = load_binary(model_file)
+    else:
+        with open(model_file, 'r') as f:
+            trained_model = deserialize(f.read())
+
+    if key is not None: _cache[key] = trained_model
+    return list(trained_model)
+
+def save(trained_model, target_file, binary=True):
+    "Save a model in the binary format or, if binary is False, as JSON"
+    path = os.path.abspath(target_file)
+    for key in [k for k in _cache if k[0] == path]: del _cache[key]
+    # replace instead of overwriting the file, which may be memory-mapped
+    temp_file = '%s.%d.tmp' % (target_file, os.getpid())
+    if binary:
+        save_binary(trained_model, temp_file)
+    else:
+        with open(temp_file, 'w') as f:
+            f.write(serialize(trained_model))
+    os.replace(temp_file, target_file)
+
+def convert(model_file, target_file, binary=True):
+    "Convert a model file to the binary or to the JSON format"
+    save(load(model_file, cache=False), target_file, binary=binary)
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='Convert a model file between ' + \
+        'the JSON and the binary format')
+    p.add_argument('model_file', help='Input model file in either format')
+    p.add_argument('target_file', help='Output model file')
+    p.add_argument('--json', action='store_true',
+        help='Write JSON instead of the binary format')
+    args = p.parse_args()
+    convert(args.model_file, args.target_file, binary=not args.json)
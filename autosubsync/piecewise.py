@@ -0,0 +1,120 @@
+"""
+Piecewise alignment: find a separate shift for each segment of the subtitle
+timeline, for example, when ad breaks or scenes have been removed from the
+video. The skew is assumed to be the same for all segments.
+"""
+import numpy as np
+
+from .features import frame_secs
+from . import find_transform
+from . import quality_of_fit
+
+def best_path(window_scores, jump_penalty):
+    """
+    Dynamic programming (Viterbi) search for the piecewise-constant path of
+    shift indices maximizing the sum of window scores minus jump_penalty for
+    each change of shift
+    """
+    n_windows, n_shifts = window_scores.shape
+    came_from = np.zeros((n_windows, n_shifts), dtype=int)
+    total = window_scores[0, :].copy()
+    for i in range(1, n_windows):
+        best_prev = np.argmax(total)
+        jump = total[best_prev] - jump_penalty > total
+        came_from[i, :] = np.where(jump, best_prev, np.arange(n_shifts))
+        total = np.where(jump, total[best_prev] - jump_penalty, total) + window_scores[i, :]
+
+    path = np.zeros(n_windows, dtype=int)
+    path[-1] = np.argmax(total)
+    for i in range(n_windows-1, 0, -1):
+        path[i-1] = came_from[i, path[i]]
+    return path
+
+def refine_boundary(labels, values, lo, hi, shift_before, shift_after):
+    """
+    Find the best frame in [lo, hi) to switch from shift_before to shift_after.
+    If there are many equally good ones (e.g., a gap between subtitles),
+    return the one in the middle
+    """
+    def cumulative(shift):
+        matched = labels[lo:hi] * find_transform.padded_slice(values, lo + shift, hi + shift, -1.0)
+        return np.concatenate([[0], np.cumsum(matched)])
+
+    gain = cumulative(shift_before) - cumulative(shift_after)
+    best = np.flatnonzero(gain >= np.max(gain) - 1e-9)
+    # pick the middle of the first plateau of best values
+    plateau_end = np.argmax(np.diff(np.append(best, best[-1] + 2)) > 1)
+    return lo + (best[0] + best[plateau_end]) // 2
+
+def find_segments(y_subs, y_probs, skew, shift, bias=0.0, max_shift_secs=300.0, \
+    window_secs=60.0, jump_penalty_secs=5.0, quality_window_secs=20.0, verbose=False):
+    """
+    Find a piecewise-constant shift over the subtitle timeline, for a fixed
+    skew, around the global best shift.
+
+    Args:
+        y_subs (array): subtitle labels for each frame
+        y_probs (array): speech probabilities for each frame
+        skew (float): skew (from the global fit)
+        shift (float): shift in seconds (from the global fit, including bias)
+        bias (float): model bias in seconds
+        max_shift_secs (float): maximum segment shift relative to the
+            global shift
+        window_secs (float): resolution of the initial segmentation
+        jump_penalty_secs (float): penalty of starting a new segment, in
+            seconds of perfectly matched subtitles
+        quality_window_secs (float): half width of the shift score curve
+            used in the per-segment quality of fit metric
+
+    Returns:
+        list of dicts with the keys 'begin' and 'end' (segment bounds as
+        subtitle timestamps in seconds), 'shift' (seconds) and 'quality'
+    """
+    labels = find_transform.skew_frame_labels(np.asarray(y_subs, dtype=float), skew)[0]
+    values = find_transform.score_values(y_probs)
+
+    center = int(round((shift - bias) / frame_secs))
+    max_shift = int(max_shift_secs / frame_secs)
+    shifts = range(center - max_shift, center + max_shift + 1)
+
+    window = max(int(window_secs / frame_secs), 1)
+    bounds = [(b, min(b + window, len(labels))) for b in range(0, len(labels), window)]
+    path = best_path(find_transform.window_correlations(labels, values, bounds, shifts), \
+        jump_penalty_secs / frame_secs)
+
+    # segment bounds in skewed frames
+    changes = [i for i in range(1, len(path)) if path[i] != path[i-1]]
+    frame_bounds = [0]
+    for i in changes:
+        lo = max(bounds[i-1][0], frame_bounds[-1])
+        hi = bounds[i][1]
+        frame_bounds.append(refine_boundary(labels, values, lo, hi, \
+            shifts[path[i-1]], shifts[path[i]]))
+    frame_bounds.append(len(labels))
+
+    quality_window = int(quality_window_secs / frame_secs)
+    segments = []
+    for begin, end in zip(frame_bounds[:-1], frame_bounds[1:]):
+        scores = find_transform.window_correlations(labels, values, [(begin, end)], shifts)[0]
+        best = np.argmax(scores)
+        local = scores[max(best - quality_window, 0):(best + quality_window + 1)]
+        segments.append({
+            'begin': begin * frame_secs / skew,
+            'end': end * frame_secs / skew,
+            'shift': shifts[best] * frame_secs + bias,
+            'quality': quality_of_fit.compute_quality(local)
+        })
+
+    if verbose:
+        print('segments:')
+        print('begin\tend\tshift\tquality')
+        for s in segments:
+            print('%.1f\t%.1f\t%.3g\t%.3g' % (s['begin'], s['end'], s['shift'], s['quality']))
+
+    return segments
+
+def segments_to_transform(skew, segments):
+    "Piecewise linear transform, works for scalars and numpy arrays"
+    bounds = np.array([s['begin'] for s in segments[1:]])
+    shifts = np.array([s['shift'] for s in segments])
+    return lambda x: x * skew + shifts[np.searchsorted(bounds, x, side='right')]
@@ -1,34 +1,17 @@
-import os
 import sys
-import tempfile
 import subprocess
 import numpy as np
 from . import srt_io
 
-def import_sound(sound_path):
-    import soundfile
+def import_sound(sound_path, target_sample_rate=20000):
+    """
+    Import a sound file, resampled to the target sample rate and
+    converted to mono by ffmpeg
 
-    target_sample_rate = 20000
-    warning_threshold = 8000
-
-    # minimize memory usage by reading audio as 16-bit integers instead of
-    # float or double. This should be the maximum precision of the samples
-    # anyway
-    samples, sample_rate = soundfile.read(sound_path, dtype='int16')
-    data_range = 2**15
-
-    # even 8-bit audio would work here, but already affects performance
-    # samples, data_range = (samples / 256).astype(np.int8), 128
-
-    ds_factor = max(int(np.floor(sample_rate / target_sample_rate)), 1)
-    samples = samples[::ds_factor]
-    sample_rate = sample_rate / ds_factor
-
-    if sample_rate < warning_threshold:
-        # probably never happens but checking anyway
-        sys.stderr.write('warning: low sound sample rate %d Hz\n' % sample_rate)
-
-    return samples, sample_rate, data_range
+    Returns:
+        tuple (samples, sample_rate, data_range)
+    """
+    return decode_sound(sound_path, sample_rate=target_sample_rate)
 
 def build_sub_vec(subs, sample_rate, n, sub_filter=None):
     subvec = np.zeros(n, bool)
@@ -38,11 +21,61 @@ def build_sub_vec(subs, sample_rate, n, sub_filter=None):
         subvec[to_index(line.begin):to_index(line.end)] = 1
     return subvec
 
-def import_subs(srt_filename, sample_rate, n, **kwargs):
-    audio_length = n / float(sample_rate)
-    subs = list(srt_io.read_file(srt_filename))
+def sub_sample_intervals(subs, sample_rate, n, sub_filter=None):
+    """
+    Subtitle lines as sorted, disjoint sample index intervals [begin, end)
+    within 0...n, with overlapping lines merged
+
+    Returns:
+        tuple (begin, end) of int64 arrays
+    """
+    if isinstance(subs, srt_io.SrtData) and sub_filter is None:
+        begin, end = subs.begin, subs.end
+    else:
+        lines = [line for line in subs if sub_filter is None or sub_filter(line.text)]
+        begin, end = [line.begin for line in lines], [line.end for line in lines]
+    # same rounding as in build_sub_vec
+    to_index = lambda x: np.clip((sample_rate*np.array(x, dtype=float)).astype(np.int64), 0, n)
+    begin, end = to_index(begin), to_index(end)
+    nonempty = end > begin
+    begin, end = begin[nonempty], end[nonempty]
+
+    order = np.argsort(begin, kind='stable')
+    begin, end = begin[order], end[order]
+    if len(begin) == 0: return begin, end
+
+    # merge each interval with the previous one if it begins before any of
+    # the previous intervals end
+    reach = np.maximum.accumulate(end)
+    first = np.ones(len(begin), dtype=bool)
+    first[1:] = begin[1:] > reach[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(begin) - 1)
+    return begin[first], reach[last]
+
+def build_frame_labels(subs, sample_rate, frame_size, n_frames, sub_filter=None):
+    """
+    Subtitle label (0 or 1) of each frame: the rounded mean of the per-sample
+    subtitle vector (see build_sub_vec) over the frame, computed exactly from
+    the subtitle intervals without the per-sample vector
+    """
+    begin, end = sub_sample_intervals(subs, sample_rate, n_frames*frame_size, sub_filter)
+
+    # number of subtitle samples before each frame boundary x: the total
+    # length of the intervals beginning before x minus the part of the last
+    # of them after x
+    bounds = np.arange(n_frames + 1, dtype=np.int64) * frame_size
+    k = np.searchsorted(begin, bounds, side='left')
+    total = np.append(0, np.cumsum(end - begin))
+    covered = total[k] - np.maximum(np.append(0, end)[k] - bounds, 0)
+
+    # np.round rounds a mean of exactly 0.5 to 0
+    return (2*np.diff(covered) > frame_size).astype(np.float32)
+
+def read_subs(srt_filename, audio_length):
+    "Read subtitles (see srt_io.read) and warn if they do not seem to match the audio"
+    subs = srt_io.read(srt_filename)
     if len(subs) > 0:
-        subs_length = np.max([s.end for s in subs])
+        subs_length = np.max(subs.end)
         rel_err = abs(subs_length - audio_length) / max(subs_length, audio_length)
         if rel_err > 0.25: # warning threshold
             sys.stderr.write(" *** WARNING: subtitle and audio lengths " + \
@@ -50,49 +83,200 @@ def import_subs(srt_filename, sample_rate, n, **kwargs):
 
     else:
         sys.stderr.write(" *** WARNING: empty subtitle file\n")
-    return build_sub_vec(subs, sample_rate, n, **kwargs)
+    return subs
+
+def import_subs_frames(srt_filename, sample_rate, frame_size, n_frames, **kwargs):
+    "Import subtitles as frame labels, see build_frame_labels"
+    subs = read_subs(srt_filename, n_frames * frame_size / float(sample_rate))
+    return build_frame_labels(subs, sample_rate, frame_size, n_frames, **kwargs)
 
 def import_item(sound_file, subtitle_file, **kwargs):
+    "Import a training item: sound data and the frame labels of its subtitles"
+    from . import features
     sound_data = import_sound(sound_file)
     samples, sample_rate, data_range = sound_data
-    n = len(samples)
-    sub_vec = import_subs(subtitle_file, sample_rate, n, **kwargs)
-    return sound_data, sub_vec
+    frame_size = int(features.frame_secs*sample_rate)
+    labels = import_subs_frames(subtitle_file, sample_rate, frame_size, \
+        len(samples) // frame_size, **kwargs)
+    return sound_data, labels
+
+def ffmpeg_command(args):
+    "ffmpeg command line with the given arguments (after global options)"
+    return ['ffmpeg', '-nostdin', '-loglevel', 'error'] + args
+
+def ffmpeg_error(returncode, stderr):
+    return RuntimeError("ffmpeg failed with exit code %d:\n\n%s" % \
+        (returncode, stderr.decode('utf-8', 'replace').strip()))
+
+def run_ffmpeg(args, capture_output=False):
+    """
+    Run ffmpeg with the given arguments (after global options)
+
+    Returns:
+        the standard output as bytes if capture_output is True
+
+    Throws:
+        RuntimeError if ffmpeg fails
+    """
+    result = subprocess.run(ffmpeg_command(args),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+
+    if result.returncode != 0:
+        raise ffmpeg_error(result.returncode, result.stderr)
+
+    return result.stdout
 
 def extract_sound(input_video_file, output_sound_file):
-    convert_cmd = [
-        'ffmpeg',
+    run_ffmpeg([
         '-y', # overwrite if exists
-        '-loglevel', 'error',
         '-i', input_video_file, # input
         '-vn', # no video
         '-sn', # no subtitles
         '-ac', '1', # convert to mono
         output_sound_file
+    ])
+
+def pcm_output_args(sample_rate, resampler='swr'):
+    """
+    ffmpeg output arguments for mono 16-bit PCM at the given sample rate,
+    written to stdout. ffmpeg downmixes and resamples with a band-limited
+    (anti-aliasing) filter so that only samples at the analysis rate reach
+    Python. The resampler is 'swr' (always available) or, e.g., 'soxr' if
+    ffmpeg has been built with libsoxr
+    """
+    sample_rate = int(sample_rate)
+    # minimize memory usage by reading audio as 16-bit integers instead of
+    # float or double. This should be the maximum precision of the samples
+    # anyway
+    return [
+        '-vn', '-sn', '-dn', # audio only
+        '-af', 'aresample=%d:resampler=%s' % (sample_rate, resampler),
+        '-ac', '1', # convert to mono
+        '-ar', str(sample_rate),
+        '-f', 's16le', '-acodec', 'pcm_s16le', # raw little-endian int16
+        'pipe:1'
     ]
-    subprocess.call(convert_cmd)
 
-def import_target_files(video_file, subtitle_file, **kwargs):
-    "Import prediction target files using a temporary directory"
-    tmp_dir = tempfile.mkdtemp()
-    sound_file = os.path.join(tmp_dir, 'sound.flac')
+def decode_sound(input_video_file, sample_rate=20000, resampler='swr', start_secs=None, duration_secs=None):
+    """
+    Decode the audio of a video file to mono 16-bit PCM at the given sample
+    rate by piping raw samples from ffmpeg, without temporary files.
+    See pcm_output_args. Optionally, only decodes a part of the file, using
+    (fast) input seeking
 
-    def clear():
-        try: os.unlink(sound_file)
-        except: pass
+    Returns:
+        tuple (samples, sample_rate, data_range)
+    """
+    seek = []
+    if start_secs is not None: seek += ['-ss', '%.3f' % start_secs]
+    if duration_secs is not None: seek += ['-t', '%.3f' % duration_secs]
 
-        try: os.rmdir(tmp_dir)
-        except: pass
+    data = run_ffmpeg(seek + ['-i', input_video_file] + \
+        pcm_output_args(sample_rate, resampler), capture_output=True)
 
-    try:
-        extract_sound(video_file, sound_file)
-        return import_item(sound_file, subtitle_file, **kwargs)
+    samples = np.frombuffer(data, dtype='<i2')
+    return samples, int(sample_rate), 2**15
+
+def probe_duration(input_video_file):
+    """
+    Get the duration of a media file in seconds from the input information
+    printed by ffmpeg (so that ffprobe is not needed)
+
+    Returns:
+        duration in seconds, or None if unknown
+    """
+    import re
+    result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', input_video_file],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    m = re.search(br'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if m is None: return None
+    hours, minutes, secs = m.groups()
+    return (int(hours)*60 + int(minutes))*60 + float(secs)
+
+def subtitle_output_args(subtitle_streams):
+    """
+    ffmpeg output arguments that convert embedded subtitle streams to SRT
+    files, added after the other outputs of an ffmpeg command
 
+    Args:
+        subtitle_streams (list): tuples (stream, srt_file), where stream is
+            an ffmpeg stream specifier of the (first) input, e.g., 's:0' for
+            the first subtitle stream or 's:m:language:eng'
+    """
+    args = []
+    for stream, srt_file in subtitle_streams:
+        args += ['-map', '0:' + stream, '-c:s', 'srt', '-f', 'srt', '-y', srt_file]
+    return args
+
+def extract_subtitles(input_video_file, subtitle_streams):
+    "Convert embedded subtitle streams to SRT files, see subtitle_output_args"
+    run_ffmpeg(['-i', input_video_file] + subtitle_output_args(subtitle_streams))
+
+def stream_sound(input_video_file, block_size, sample_rate=20000, resampler='swr', \
+    subtitle_streams=()):
+    """
+    Like decode_sound, but yields the samples in blocks of block_size
+    samples (the last one may be shorter) as they are decoded, so that the
+    whole soundtrack is never held in memory. If the generator is closed
+    early, ffmpeg is killed. Optionally, the same ffmpeg process also
+    converts embedded subtitle streams to SRT files (see
+    subtitle_output_args), which are complete when the generator is
+    exhausted, so that the input is read only once.
+
+    Yields:
+        numpy int16 arrays
+
+    Throws:
+        RuntimeError if ffmpeg fails
+    """
+    import threading
+
+    proc = subprocess.Popen(ffmpeg_command(['-i', input_video_file] + \
+            pcm_output_args(sample_rate, resampler) + \
+            subtitle_output_args(subtitle_streams)),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # read stderr in the background so that ffmpeg never blocks on it
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+    stderr_reader.daemon = True
+    stderr_reader.start()
+
+    completed = False
+    try:
+        while True:
+            data = proc.stdout.read(block_size*2)
+            if len(data) < 2: break
+            yield np.frombuffer(data[:(len(data)//2*2)], dtype='<i2')
+        completed = True
     finally:
-        clear()
+        if not completed: proc.kill()
+        proc.wait()
+        stderr_reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if proc.returncode != 0:
+        raise ffmpeg_error(proc.returncode, stderr[0] if stderr else b'')
+
+def import_target_files(video_file, subtitle_file, sample_rate=20000, **kwargs):
+    "Import prediction target files, decoding the audio with ffmpeg"
+    from . import features
+    sound_data = decode_sound(video_file, sample_rate=sample_rate)
+    samples, sample_rate, data_range = sound_data
+    frame_size = int(features.frame_secs*sample_rate)
+    labels = import_subs_frames(subtitle_file, sample_rate, frame_size, \
+        len(samples) // frame_size, **kwargs)
+    return sound_data, labels
 
 def transform_srt(in_srt, out_srt, transform_func):
+    """
+    Write the subtitles in_srt (a file name or srt_io.SrtData) with the
+    timestamps transformed by transform_func, which is applied to arrays
+    """
+    subs = srt_io.read(in_srt)
     with open(out_srt, 'wb') as out_file:
-        out_srt = srt_io.writer(out_file)
-        for sub in srt_io.read_file(in_srt):
-            out_srt.write(transform_func(sub.begin), transform_func(sub.end), sub.text)
+        srt_io.writer(out_file).write_many(transform_func(subs.begin), \
+            transform_func(subs.end), subs.texts())
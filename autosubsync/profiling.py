@@ -0,0 +1,293 @@
+"""
+Lightweight instrumentation of the synchronization pipeline: wall and CPU
+time per stage and counters such as the number of frames. Stages may be
+nested, e.g., reading the next audio block from ffmpeg while computing
+features in a streaming pipeline, and the time of a stage excludes the
+time of the stages nested in it.
+
+In the opt-in memory mode, the peak resident set size (RSS) of this
+process and the total memory of its child processes (pool workers and
+ffmpeg) are sampled during each stage, as well as the peak of the memory
+traced by tracemalloc in this process with its top allocation sites.
+Memory peaks of a stage include the stages nested in it.
+
+Usage:
+    profiler = Profiler(memory=True)
+    synchronize(..., profiler=profiler)
+    profiler.close()
+    print(profiler.report())
+"""
+import contextlib
+import os
+import threading
+import time
+
+class _Entry:
+    "An active stage"
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.peak_rss = 0
+        self.peak_children_rss = 0
+        self.peak_traced = 0
+        self.snapshot = None
+
+class Profiler:
+    def __init__(self, callback=None, memory=False, sample_interval_secs=0.02, \
+        top_allocations=5):
+        """
+        Args:
+            callback (function): if given, called as callback(stage, wall_secs,
+                cpu_secs) each time a stage is exited
+            memory (boolean): if True, also record memory use per stage.
+                This has a significant overhead
+            sample_interval_secs (float): RSS sampling interval in memory mode
+            top_allocations (int): number of top allocation sites to record
+                per stage in memory mode
+        """
+        self.callback = callback
+        self.stages = {}
+        self.counters = {}
+        self._stack = []
+        self._begin = time.time()
+
+        self.memory = memory
+        self.top_allocations = top_allocations
+        if memory:
+            import tracemalloc
+            self._lock = threading.Lock()
+            self._started_tracemalloc = not tracemalloc.is_tracing()
+            if self._started_tracemalloc: tracemalloc.start()
+            self._stop = threading.Event()
+            self._sampler = threading.Thread(target=self._sample_loop, \
+                args=(sample_interval_secs,))
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        "Context manager that measures the time spent in a stage"
+        entry = _Entry(name)
+        if self.memory: self._enter_memory(entry)
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            if self.memory: self._exit_memory(entry)
+            self._stack.pop()
+            wall = time.perf_counter() - entry.wall
+            cpu = time.process_time() - entry.cpu
+            if self._stack:
+                self._stack[-1].child_wall += wall
+                self._stack[-1].child_cpu += cpu
+            self._add(entry, wall - entry.child_wall, cpu - entry.child_cpu)
+
+    def _add(self, entry, wall, cpu):
+        s = self.stages.setdefault(entry.name, { 'wall_secs': 0.0, 'cpu_secs': 0.0, 'calls': 0 })
+        s['wall_secs'] += wall
+        s['cpu_secs'] += cpu
+        s['calls'] += 1
+        if self.memory:
+            mb = lambda x: x / 2.0**20
+            for key, value in [('peak_rss_mb', mb(entry.peak_rss)), \
+                ('peak_children_mb', mb(entry.peak_children_rss)), \
+                ('peak_traced_mb', mb(entry.peak_traced))]:
+                s[key] = max(s.get(key, 0.0), value)
+            if entry.snapshot is not None and \
+                mb(entry.peak_traced) >= s.get('_top_allocations_peak', 0.0):
+                s['_top_allocations_peak'] = mb(entry.peak_traced)
+                s['top_allocations'] = self._top_allocations(entry.snapshot)
+        if self.callback is not None: self.callback(entry.name, wall, cpu)
+
+    def iterate(self, name, iterable, counter=None):
+        """
+        Wrap an iterable (e.g., a generator stage of a streaming pipeline)
+        so that the time spent producing each item is counted to the stage
+        name and, optionally, the number of items to the given counter
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            if counter is not None: self.count(counter)
+            yield item
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def report(self):
+        """
+        Returns:
+            a JSON-serializable dict with the keys 'stages' (per stage
+            wall_secs, cpu_secs, calls and, in memory mode, peak_rss_mb,
+            peak_children_mb, peak_traced_mb and top_allocations),
+            'counters' and 'total_wall_secs'. CPU times are those of this
+            process and do not include ffmpeg or worker processes
+        """
+        stages = {}
+        for name, s in self.stages.items():
+            stages[name] = dict((k, v) for k, v in s.items() if not k.startswith('_'))
+        report = {
+            'stages': stages,
+            'counters': dict(self.counters),
+            'total_wall_secs': time.time() - self._begin
+        }
+        if self.memory:
+            report['memory'] = _lifetime_peaks()
+        return report
+
+    def close(self):
+        "Stop memory sampling"
+        if self.memory and not self._stop.is_set():
+            self._stop.set()
+            self._sampler.join()
+            if self._started_tracemalloc:
+                import tracemalloc
+                tracemalloc.stop()
+
+    # --- memory mode
+
+    def _enter_memory(self, entry):
+        with self._lock:
+            # the peak so far belongs to the parent stage
+            if self._stack:
+                parent = self._stack[-1]
+                parent.peak_traced = max(parent.peak_traced, _traced_peak())
+            _reset_traced_peak()
+        self._sample(entry)
+
+    def _exit_memory(self, entry):
+        self._sample(entry)
+        with self._lock:
+            entry.peak_traced = max(entry.peak_traced, _traced_peak())
+            if len(self._stack) > 1:
+                parent = self._stack[-2]
+                parent.peak_traced = max(parent.peak_traced, entry.peak_traced)
+                parent.peak_rss = max(parent.peak_rss, entry.peak_rss)
+                parent.peak_children_rss = max(parent.peak_children_rss, entry.peak_children_rss)
+            _reset_traced_peak()
+
+    def _sample(self, entry=None):
+        import tracemalloc
+        rss, children_rss = _rss(), _children_rss()
+        with self._lock:
+            entries = list(self._stack) + ([entry] if entry is not None else [])
+            for e in entries:
+                e.peak_rss = max(e.peak_rss, rss)
+                e.peak_children_rss = max(e.peak_children_rss, children_rss)
+            if not self._stack or self.top_allocations <= 0: return
+            # snapshot the allocations of the innermost stage near its peak
+            top = self._stack[-1]
+            traced = tracemalloc.get_traced_memory()[0]
+            take_snapshot = traced > 1.1*top.peak_traced
+            top.peak_traced = max(top.peak_traced, traced)
+        if take_snapshot:
+            top.snapshot = tracemalloc.take_snapshot()
+
+    def _sample_loop(self, interval):
+        while not self._stop.wait(interval):
+            self._sample()
+
+    def _top_allocations(self, snapshot):
+        return [{
+            'location': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+            'size_mb': stat.size / 2.0**20,
+            'count': stat.count
+        } for stat in snapshot.statistics('lineno')[:self.top_allocations]]
+
+def _traced_peak():
+    """
+    Peak traced memory since the last _reset_traced_peak. Before Python 3.9,
+    the peak cannot be reset and the current traced memory is returned
+    instead, so that the peak of a stage is only that seen by the sampling
+    """
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    return peak if hasattr(tracemalloc, 'reset_peak') else current
+
+def _reset_traced_peak():
+    import tracemalloc
+    if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+
+def _read_pss(pid):
+    """
+    Proportional set size of a process in bytes, where pages shared with
+    other processes, e.g., forked workers, are split between them. Falls
+    back to the RSS on older Linux kernels (and 0 on other systems)
+    """
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return _read_rss(pid)
+
+def _read_rss(pid):
+    "Resident set size of a process in bytes (Linux only, else 0)"
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+def _rss():
+    return _read_rss('self')
+
+def _children_rss():
+    "Total memory (PSS) of the child processes of this process"
+    my_pid = os.getpid()
+    total = 0
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # the process name may contain spaces, the fields after it do not
+        if int(stat.rpartition(')')[2].split()[1]) == my_pid:
+            total += _read_pss(pid)
+    return total
+
+def _lifetime_peaks():
+    "Peak RSS of this process and its largest finished child process"
+    try:
+        import resource, sys
+    except ImportError:
+        return {}
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    mb = lambda x: x * unit / 2.0**20
+    return {
+        'max_rss_mb': mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        'max_child_rss_mb': mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    }
+
+class _DisabledProfiler:
+    "Profiler interface that does nothing, used when profiling is disabled"
+    _context = contextlib.nullcontext()
+
+    def stage(self, name): return self._context
+    def iterate(self, name, iterable, counter=None): return iterable
+    def count(self, name, value=1): pass
+    def set(self, name, value): pass
+
+disabled = _DisabledProfiler()
+
+def get(profiler):
+    "The given profiler or the disabled one if None"
+    return disabled if profiler is None else profiler
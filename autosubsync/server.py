@@ -0,0 +1,320 @@
+"""
+Long-running synchronization server that keeps the model and the worker
+pool warm between jobs.
+
+Listens on localhost HTTP or a Unix socket. Jobs are POSTed to /sync as
+JSON objects with the keys video_file, subtitle_file and output_file (paths
+on the server) and optionally search parameters (see job_parameters), e.g.,
+
+    curl -d '{"video_file": "movie.mp4", "subtitle_file": "movie.srt",
+        "output_file": "movie-synced.srt"}' http://localhost:8765/sync
+
+and the response has the same values as synchronize(return_parameters=True):
+success, quality, skew, shift and, in segmented mode, segments. With
+estimate_skew, it also has skew_fit_residual_secs, the residual of the
+drift fit (see find_transform.estimate_drift) or null if it failed, and
+with sampled_segments, analyzed_fraction, the fraction of the audio
+analyzed. At most max_concurrent jobs run at a time and at most max_queue
+more wait for their turn, further jobs are rejected with HTTP status 503.
+GET /health returns the queue depth and other statistics.
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+job_files = ['video_file', 'subtitle_file', 'output_file']
+
+def _number(value):
+    # bool is a subclass of int but not a valid number here
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('expected a number')
+    return float(value)
+
+def _optional_number(value):
+    return None if value is None else _number(value)
+
+def _optional_count(value):
+    if value is None: return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError('expected a positive integer')
+    return value
+
+def _flag(value):
+    if not isinstance(value, bool): raise ValueError('expected true or false')
+    return value
+
+def _skew(value):
+    from autosubsync.main import parse_skew
+    if isinstance(value, bool) or not isinstance(value, (int, float, str, type(None))):
+        raise ValueError('expected a number or a string like "24/25"')
+    try:
+        return parse_skew(value)
+    except ZeroDivisionError:
+        raise ValueError('division by zero')
+
+# search parameters that can be set per job and functions that validate
+# and convert their JSON values, the other parameters are fixed per server
+job_parameters = {
+    'fixed_skew': _skew,
+    'max_shift_secs': _number,
+    'coarse_shift_secs': _optional_number,
+    'estimate_skew': _flag,
+    'segmented': _flag,
+    'max_segment_shift_secs': _number,
+    'sampled_segments': _optional_count,
+    'sampled_segment_secs': _number
+}
+
+# profiler counters included in the results if present
+reported_counters = ['skew_fit_residual_secs', 'analyzed_fraction']
+
+class QueueFull(Exception):
+    pass
+
+def check_job(job):
+    """
+    Validate a /sync request
+
+    Returns:
+        the job with the parameter values converted
+
+    Raises:
+        ValueError: if the job is invalid
+    """
+    if not isinstance(job, dict): raise ValueError('expected a JSON object')
+    missing = [k for k in job_files if k not in job]
+    unknown = [k for k in job if k not in job_files and k not in job_parameters]
+    if missing or unknown:
+        raise ValueError('missing keys: %s, unknown keys: %s' % \
+            (', '.join(missing) or '-', ', '.join(unknown) or '-'))
+    converted = {}
+    for k in job_files:
+        if not isinstance(job[k], str): raise ValueError('%s: expected a string' % k)
+        converted[k] = job[k]
+    for k, convert in job_parameters.items():
+        if k not in job: continue
+        try:
+            converted[k] = convert(job[k])
+        except ValueError as e:
+            raise ValueError('%s: %s' % (k, e))
+    return converted
+
+class SyncService:
+    """
+    The model, worker pool and job queue of a server. Thread-safe: run is
+    called from the request handler threads
+    """
+    def __init__(self, model_file=None, parallelism=3, parallel_backend='process', \
+        max_concurrent=1, max_queue=16, verbose=False, **kwargs):
+        """
+        Args:
+            model_file (string): model file, None for the packaged model
+            parallelism (int): number of workers in the shared worker pool
+            parallel_backend (string): worker pool type, see features.Executor
+            max_concurrent (int): maximum number of jobs running at a time
+            max_queue (int): maximum number of jobs waiting to run
+            verbose (boolean): print a line per job
+            other arguments: defaults for all jobs, passed to synchronize
+        """
+        from autosubsync import features
+        from autosubsync.main import _load_model
+
+        self.trained_model = _load_model(model_file)
+        self.parallelism = parallelism
+        self.executor = features.Executor(parallelism, parallel_backend) \
+            if parallelism > 1 else None
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.verbose = verbose
+        self.defaults = kwargs
+
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrent)
+        self._begin = time.time()
+        self.stats = { 'queued': 0, 'running': 0, 'completed': 0, \
+            'failed': 0, 'rejected': 0 }
+
+    def run(self, job):
+        """
+        Synchronize one job, waiting for a free slot if necessary
+
+        Args:
+            job (dict): video_file, subtitle_file, output_file and optional
+                job_parameters
+
+        Returns:
+            a dict with the keys success, quality, skew, shift, timings,
+            the reported_counters that are available and, in segmented
+            mode, segments
+
+        Raises:
+            QueueFull: if the queue is full
+            ValueError: if the job is invalid
+        """
+        from autosubsync import profiling
+        from autosubsync.main import synchronize_many
+
+        job = check_job(job)
+        kwargs = dict(self.defaults)
+        kwargs.update((k, job[k]) for k in job_parameters if k in job)
+
+        with self._lock:
+            if self.stats['queued'] + self.stats['running'] >= \
+                self.max_concurrent + self.max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFull('queue full (%d jobs)' % self.stats['queued'])
+            self.stats['queued'] += 1
+
+        with self._slots:
+            with self._lock:
+                self.stats['queued'] -= 1
+                self.stats['running'] += 1
+            profiler = profiling.Profiler()
+            try:
+                result = synchronize_many(job['video_file'], [job['subtitle_file']], \
+                    [job['output_file']], parallelism=self.parallelism, \
+                    executor=self.executor, trained_model=self.trained_model, \
+                    profiler=profiler, return_parameters=True, **kwargs)[0]
+            except Exception:
+                with self._lock: self.stats['failed'] += 1
+                raise
+            finally:
+                with self._lock: self.stats['running'] -= 1
+
+        with self._lock: self.stats['completed'] += 1
+        success, quality, skew, shift = result[:4]
+        segments = result[4] if len(result) > 4 else None
+        result = {
+            'success': bool(success),
+            'quality': float(quality),
+            'skew': float(skew),
+            'shift': float(shift),
+            'timings': dict((k, v['wall_secs']) for k, v in profiler.report()['stages'].items())
+        }
+        result.update((k, profiler.counters[k]) for k in reported_counters \
+            if k in profiler.counters)
+        if segments is not None:
+            result['segments'] = [dict((k, float(v)) for k, v in s.items()) \
+                for s in segments]
+        if self.verbose:
+            print('%s: quality %.3f%s' % (job['output_file'], quality, \
+                '' if success else ' (FAILED)'))
+        return result
+
+    def health(self):
+        with self._lock: stats = dict(self.stats)
+        stats.update({
+            'status': 'ok',
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue,
+            'workers': self.parallelism,
+            'uptime_secs': time.time() - self._begin
+        })
+        return stats
+
+    def close(self):
+        "Stop the worker pool, jobs still running fail"
+        if self.executor is not None: self.executor.terminate()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    "HTTP interface of a SyncService, set as the service attribute of the server"
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._respond(200, self.server.service.health())
+        else:
+            self._respond(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        if self.path != '/sync':
+            return self._respond(404, { 'error': 'not found' })
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = check_job(job)
+        except ValueError as e:
+            return self._respond(400, { 'error': '%s: %s' % (type(e).__name__, e) })
+        try:
+            result = self.server.service.run(job)
+        except QueueFull as e:
+            return self._respond(503, { 'error': str(e) })
+        except Exception as e:
+            return self._respond(500, { 'error': '%s: %s' % (type(e).__name__, e) })
+        self._respond(200, result)
+
+    def _respond(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def create_server(service, host='127.0.0.1', port=8765, unix_socket=None):
+    """
+    Create an HTTP server for a SyncService. Call serve_forever to run it
+
+    Args:
+        service (SyncService): the service
+        host (string): address to listen on
+        port (int): port to listen on, 0 for any free port
+        unix_socket (string): if given, listen on this Unix socket instead
+    """
+    if unix_socket is not None:
+        if os.path.exists(unix_socket): os.unlink(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    return server
+
+def cli(packaged_model=False, argv=None):
+    from autosubsync.main import add_sync_arguments, sync_arguments
+
+    p = argparse.ArgumentParser(prog='autosubsync serve',
+        description=__doc__.strip().split('\n\n')[0])
+    p.add_argument('--host', default='127.0.0.1',
+        help='Address to listen on (default 127.0.0.1)')
+    p.add_argument('--port', default=8765, type=int,
+        help='Port to listen on (default 8765)')
+    p.add_argument('--unix_socket', '--unix-socket', default=None, metavar='PATH',
+        help='Listen on this Unix socket instead of TCP')
+    p.add_argument('--max_concurrent', default=1, type=int,
+        help='Maximum number of jobs running at a time (default 1)')
+    p.add_argument('--max_queue', default=16, type=int,
+        help='Maximum number of jobs waiting to run (default 16)')
+    add_sync_arguments(p, packaged_model)
+    args = p.parse_args(argv)
+
+    service = SyncService(max_concurrent=args.max_concurrent, \
+        max_queue=args.max_queue, verbose=not args.silent, \
+        **sync_arguments(args, packaged_model))
+    server = create_server(service, args.host, args.port, args.unix_socket)
+    if not args.silent:
+        print('listening on %s' % (args.unix_socket or \
+            'http://%s:%d' % server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
@@ -0,0 +1,114 @@
+"""
+Sharing large numpy arrays with worker processes without pickling them.
+
+Arrays are written once to memory-mapped .npy scratch files (in /dev/shm
+where available and it has enough free space, so they never touch the
+disk, otherwise in the temporary directory) and workers receive small
+picklable handles that map the same pages read-only (memory-mapped files
+are coherent across processes, so no flushing is needed). The scratch files are
+deleted when the owning SharedArrays context exits, also on errors.
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+shm_dir = '/dev/shm'
+
+# scratch files are only written to shm_dir if at least this many bytes
+# would remain free. /dev/shm may be small (64 MB in Docker by default)
+# and running out of it crashes the process (SIGBUS) when the mapping is
+# written to, instead of raising an error
+shm_min_free_bytes = 2**25
+
+def _free_bytes(path):
+    try:
+        st = os.statvfs(path)
+    except (OSError, AttributeError):
+        return 0
+    return st.f_bavail * st.f_frsize
+
+def scratch_base_dir(nbytes):
+    "Directory for a scratch file of nbytes: shm_dir if it has room, else the temp dir"
+    if os.path.isdir(shm_dir) and _free_bytes(shm_dir) >= nbytes + shm_min_free_bytes:
+        return shm_dir
+    return tempfile.gettempdir()
+
+class SharedArray:
+    "Picklable handle of a shared array, see attach"
+    def __init__(self, path):
+        self.path = path
+
+def attach(array):
+    """
+    Returns the (read-only) numpy array behind a SharedArray handle, or
+    the argument itself if it is not a handle
+    """
+    if isinstance(array, SharedArray):
+        return np.load(array.path, mmap_mode='r')
+    return array
+
+def uses_processes(parallelism=1, executor=None):
+    "Whether the arguments of maybe_parallel_map(..., parallelism, executor) are pickled"
+    if executor is not None:
+        return executor.backend != 'thread'
+    return parallelism > 1
+
+class SharedArrays:
+    """
+    Owner of a set of shared arrays. If not enabled (e.g., no worker
+    processes are used), the arrays are passed as is
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # scratch directory in each base directory, see scratch_base_dir
+        self.directories = {}
+        self.slots = {}
+        self.count = 0
+
+    def _write(self, array):
+        base_dir = scratch_base_dir(array.nbytes)
+        if base_dir not in self.directories:
+            self.directories[base_dir] = tempfile.mkdtemp(prefix='autosubsync-', dir=base_dir)
+        path = os.path.join(self.directories[base_dir], '%d.npy' % self.count)
+        self.count += 1
+        mapped = np.lib.format.open_memmap(path, mode='w+', \
+            dtype=array.dtype, shape=array.shape)
+        mapped[...] = array
+        return mapped, SharedArray(path)
+
+    def share(self, array):
+        "Copy an array to shared memory once and return its handle"
+        if not self.enabled: return array
+        return self._write(np.asarray(array))[1]
+
+    def share_in_slot(self, slot, array):
+        """
+        Copy an array to a reusable shared buffer and return its handle.
+        The previous contents of the slot must no longer be in use
+        """
+        if not self.enabled: return array
+        array = np.asarray(array)
+        mapped, handle = self.slots.get(slot, (None, None))
+        if mapped is not None and mapped.shape == array.shape and mapped.dtype == array.dtype:
+            mapped[...] = array
+        else:
+            if mapped is not None:
+                del mapped
+                os.unlink(handle.path)
+            mapped, handle = self._write(array)
+            self.slots[slot] = (mapped, handle)
+        return handle
+
+    def close(self):
+        "Delete all shared arrays. Mappings already open in workers stay valid"
+        self.slots = {}
+        for directory in self.directories.values():
+            shutil.rmtree(directory, ignore_errors=True)
+        self.directories = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,69 +3,180 @@ Module for reading and writing the SRT format. Attempts to deal with
 different encodings in a pass-through fashion: read and write as binary.
 """
 
-def read_file_tuples(input_file):
+def _normalize(data):
+    "Remove UTF BOMs if present and convert line endings to UNIX"
+    BOMS = [b'\xEF\xBB\xBF', b'\xFE\xFF']
+    for bom in BOMS:
+        if data.startswith(bom):
+            data = data[len(bom):]
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+def _line_blocks(data):
+    "combine invalid SRT line blocks with double line breaks"
+    last_block = []
+    blocks = []
+    for line_block in data.split(b'\n\n'):
+        line_block = line_block.strip()
+        if len(line_block) == 0: continue
+        block = line_block.split(b'\n')
+        try: int(block[0])
+        except:
+            last_block.extend(block)
+            continue
+
+        blocks.append(block)
+        last_block = block
+    return blocks
+
+def _parse_time(timestamp):
+    hours, minutes, secs = timestamp.split(b':')
+    return (int(hours)*60 + int(minutes))*60 + float(secs.replace(b',', b'.'))
+
+# byte layout of a standard timing line, parsed without Python string ops
+_TIMING_LENGTH = len(b'00:00:00,000 --> 00:00:00,000')
+_TIMING_DIGITS = [0, 1, 3, 4, 6, 7, 9, 10, 11]
+_TIMING_SEPARATORS = dict([(2, b':'), (5, b':'), (12, b' --> '), (19, b':'), (22, b':')])
+
+def _parse_timings(lines):
     """
-    Read an SRT file to (seq, begin, end, text) tuples, where
-    begin and end are float timestamps in seconds. Text is
-    actually binary since we don't really care about the encoding here
+    Parse SRT timing lines "begin --> end" to arrays of begin and end
+    timestamps in seconds. Lines in the standard format are parsed at once
+    with numpy, giving the same result as the per-line parsing used for
+    the others
+    """
+    import numpy as np
+    n = len(lines)
+    begin, end = np.empty(n), np.empty(n)
+    standard = np.flatnonzero(np.array([len(l) for l in lines], dtype=int) == _TIMING_LENGTH)
+    others = np.ones(n, dtype=bool)
 
-    Args:
-        input_file (string): input file name
+    if len(standard) > 0:
+        chars = np.frombuffer(b''.join([lines[i] for i in standard]), dtype=np.uint8)
+        chars = np.reshape(chars, (len(standard), _TIMING_LENGTH))
+        valid = np.ones(len(standard), dtype=bool)
+        for col, sep in _TIMING_SEPARATORS.items():
+            valid &= np.all(chars[:, col:(col + len(sep))] == np.frombuffer(sep, np.uint8), axis=1)
+        for col in [8, 25]:
+            valid &= (chars[:, col] == ord(',')) | (chars[:, col] == ord('.'))
 
-    Yields:
-        generator of tuples (seq, begin, end, text)
+        for offset, result in [(0, begin), (17, end)]:
+            digits = chars[:, [offset + c for c in _TIMING_DIGITS]].astype(np.int64) - ord('0')
+            valid &= np.all((digits >= 0) & (digits <= 9), axis=1)
+            hours = digits[:, 0]*10 + digits[:, 1]
+            minutes = digits[:, 2]*10 + digits[:, 3]
+            msecs = np.dot(digits[:, 4:], [10000, 1000, 100, 10, 1])
+            # an exact integer division is correctly rounded like float()
+            result[standard] = (hours*60 + minutes)*60 + msecs / 1000.0
+
+        others[standard[valid]] = False
+
+    for i in np.flatnonzero(others):
+        b, _, e = lines[i].partition(b' --> ')
+        begin[i], end[i] = _parse_time(b), _parse_time(e)
+
+    return begin, end
+
+class SrtData:
     """
-    def parse_time(timestamp):
-        hours, minutes, secs = timestamp.split(b':')
-        return (int(hours)*60 + int(minutes))*60 + float(secs.replace(b',', b'.'))
-
-    def convert_line_ending(data):
-        "Convert line endings to UNIX"
-        return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
-
-    def remove_boms(data):
-        "remove UTF BOMs if present"
-        BOMS = [b'\xEF\xBB\xBF', b'\xFE\xFF']
-        for bom in BOMS:
-            if data.startswith(bom):
-                data = data[len(bom):]
-        return data
-
-    def get_line_blocks(data):
-        "combine invalid SRT line blocks with double line breaks"
-        last_block = []
-        blocks = []
-        for line_block in data.split(b'\n\n'):
-            line_block = line_block.strip()
-            if len(line_block) == 0: continue
-            block = line_block.split(b'\n')
-            try: int(block[0])
-            except:
-                last_block.extend(block)
-                continue
-
-            blocks.append(block)
-            last_block = block
-        return blocks
+    Columnar contents of an SRT file, see read
 
-    with open(input_file, 'rb') as f:
-        srt_data = f.read()
+    Attributes:
+        seq (np.array): integer sequence numbers of the entries
+        begin (np.array): begin timestamps in seconds
+        end (np.array): end timestamps in seconds
+        text_buffer (binary string): the texts of all entries concatenated,
+            the text of entry i is text_buffer[text_offsets[i]:text_offsets[i+1]]
+        text_offsets (np.array): len(self) + 1 offsets to text_buffer
+    """
+    def __init__(self, seq, begin, end, text_buffer, text_offsets):
+        self.seq = seq
+        self.begin = begin
+        self.end = end
+        self.text_buffer = text_buffer
+        self.text_offsets = text_offsets
 
-    srt_data = convert_line_ending(remove_boms(srt_data))
+    def __len__(self):
+        return len(self.begin)
 
-    error = None
+    def text(self, i):
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i+1]]
+
+    def texts(self):
+        "List of the texts of all entries"
+        offsets = self.text_offsets.tolist()
+        return [self.text_buffer[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def __iter__(self):
+        "Iterate as SrtEntry objects"
+        for seq, begin, end, text in zip(self.seq.tolist(), self.begin.tolist(), \
+            self.end.tolist(), self.texts()):
+            entry = SrtEntry()
+            entry.seq = seq
+            entry.begin = begin
+            entry.end = end
+            entry.text = text
+            yield(entry)
+
+def parse(srt_data, name='<data>'):
+    """
+    Parse the contents of an SRT file in a single pass, see read
+
+    Args:
+        srt_data (binary string): contents of an SRT file
+        name (string): file name for error messages
+
+    Returns:
+        an SrtData object
+
+    Throws:
+        RuntimeError if the data is not valid SRT
+    """
+    import numpy as np
     try:
-        for block in get_line_blocks(srt_data):
-            seq = int(block[0])
-            times = block[1]
-            begin, _, end = times.partition(b' --> ')
-            text = b'\n'.join(block[2:])
-            yield(seq, parse_time(begin), parse_time(end), text)
+        blocks = _line_blocks(_normalize(srt_data))
+        seq = np.array([int(block[0]) for block in blocks], dtype=np.int64)
+        begin, end = _parse_timings([block[1] for block in blocks])
+        texts = [b'\n'.join(block[2:]) for block in blocks]
     except Exception as err:
-        error = RuntimeError("%s\n\n\tUnable to parse '%s'. Is it a valid SRT file?\n" \
-            % (err, input_file))
+        raise RuntimeError("%s\n\n\tUnable to parse '%s'. Is it a valid SRT file?\n" \
+            % (err, name))
 
-    if error is not None: raise error
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in texts], out=text_offsets[1:])
+    return SrtData(seq, begin, end, b''.join(texts), text_offsets)
+
+def read(input_file):
+    """
+    Read an SRT file to a columnar SrtData object. Text is actually binary
+    since we don't really care about the encoding here
+
+    Args:
+        input_file (string): input file name, or an already read SrtData,
+            which is returned as is
+
+    Returns:
+        an SrtData object
+
+    Throws:
+        RuntimeError if the file was not valid
+    """
+    if isinstance(input_file, SrtData): return input_file
+    with open(input_file, 'rb') as f:
+        return parse(f.read(), input_file)
+
+def read_file_tuples(input_file):
+    """
+    Read an SRT file to (seq, begin, end, text) tuples, where
+    begin and end are float timestamps in seconds
+
+    Args:
+        input_file (string): input file name
+
+    Yields:
+        generator of tuples (seq, begin, end, text)
+    """
+    for entry in read(input_file):
+        yield(entry.seq, entry.begin, entry.end, entry.text)
 
 class SrtEntry:
     """
@@ -89,12 +200,7 @@ def read_file(input_file):
     Yields:
         generator of SrtEntry objects
     """
-    for seq, begin, end, text in read_file_tuples(input_file):
-        entry = SrtEntry()
-        entry.seq = seq
-        entry.begin = begin
-        entry.end = end
-        entry.text = text
+    for entry in read(input_file):
         yield(entry)
 
 def check_file(input_file):
@@ -104,10 +210,14 @@ def check_file(input_file):
     Args:
         input_file (string): input file name
 
+    Returns:
+        the SrtData read from the file, which can be passed on instead of
+        the file name to avoid parsing it again
+
     Throws:
         RuntimeError if the file was not valid
     """
-    list(read_file(input_file))
+    return read(input_file)
 
 
 class writer:
@@ -134,11 +244,29 @@ class writer:
             text (binary string): text
         """
         self._write_line_ascii(self.seq)
-        self._write_line_ascii(self._format_time(begin) + ' --> ' + self._format_time(end))
+        self._write_line_ascii(_format_time(begin) + ' --> ' + _format_time(end))
         self._write_line_binary(text) # can be almost any encoding
         self._write_line_ascii('') # empty line
         self.seq += 1
 
+    def write_many(self, begin, end, texts):
+        """
+        Write many SRT entries in a single write, formatting the timestamps
+        with numpy. The same output as calling write for each entry
+
+        Args:
+            begin (array-like): begin timestamps
+            end (array-like): end timestamps
+            texts (list): binary texts
+        """
+        begin_times, end_times = _format_times(begin), _format_times(end)
+        parts = []
+        for t0, t1, text in zip(begin_times, end_times, texts):
+            parts.append(b'%d\r\n%s --> %s\r\n%s\r\n\r\n' % \
+                (self.seq, t0, t1, text.rstrip().replace(b'\n', b'\r\n')))
+            self.seq += 1
+        self.file.write(b''.join(parts))
+
     def write_entry(self, srt_entry):
         """
         Write an SRT entry.
@@ -161,11 +289,36 @@ class writer:
         data = data.rstrip().replace(b'\n', b'\r\n')
         self.file.write(data + b'\r\n')
 
-    def _format_time(self, t_secs):
-        "Convert float seconds to SRT timestamp format"
-        msecs = round(t_secs*1000)
-        secs = int(msecs / 1000) % 60
-        mins = int(msecs / (60*1000)) % 60
-        hours = int(msecs / (60*60*1000))
-        msecs = msecs % 1000
-        return "%02d:%02d:%02d,%03d" % (hours, mins, secs, msecs)
+def _format_time(t_secs):
+    "Convert float seconds to SRT timestamp format"
+    msecs = round(t_secs*1000)
+    secs = int(msecs / 1000) % 60
+    mins = int(msecs / (60*1000)) % 60
+    hours = int(msecs / (60*60*1000))
+    msecs = msecs % 1000
+    return "%02d:%02d:%02d,%03d" % (hours, mins, secs, msecs)
+
+def _format_times(t_secs):
+    "Vectorized _format_time, as a list of binary strings"
+    import numpy as np
+    t_secs = np.asarray(t_secs, dtype=float)
+    msecs = np.round(t_secs*1000)
+    # timestamps that do not fit in the fixed-width format are formatted
+    # one by one
+    standard = (msecs >= 0) & (msecs < 100*60*60*1000)
+    m = np.where(standard, msecs, 0).astype(np.int64)
+    fields = [m // (60*60*1000), m // (60*1000) % 60, m // 1000 % 60, m % 1000]
+
+    chars = np.empty((len(m), len(b'00:00:00,000')), dtype=np.uint8)
+    chars[:, [2, 5]] = ord(':')
+    chars[:, 8] = ord(',')
+    for field, cols in zip(fields, [[0, 1], [3, 4], [6, 7], [9, 10, 11]]):
+        for i, col in enumerate(cols):
+            chars[:, col] = ord('0') + field // 10**(len(cols) - 1 - i) % 10
+
+    data = chars.tobytes()
+    width = chars.shape[1]
+    times = [data[(i*width):((i+1)*width)] for i in range(len(m))]
+    for i in np.flatnonzero(~standard):
+        times[i] = _format_time(float(t_secs[i])).encode('ascii')
+    return times
@@ -19,13 +19,15 @@ class TrainedLogisticRegression:
         x_1, ..., x_n
 
         Args:
-            coefficients (list-like): array of coefficients b_1, ..., b_n
+            coefficients (array-like): array of coefficients b_1, ..., b_n,
+                kept as a contiguous float64 array (not copied if it
+                already is one, e.g., a memory-mapped array)
             bias (float): scalar intercept / bias b_0
         """
-        self.coefficients = list(np.ravel(coefficients))
+        self.coefficients = np.ascontiguousarray(np.ravel(coefficients), dtype=np.float64)
         self.bias = bias
 
-    def predict_proba(self, data_x):
+    def predict_proba(self, data_x, transform_dot=None):
         """
         Compute probabilies of 0 and 1 classes given a matrix of predictors.
         Mimics the corresponding method in the scikit learn classs
@@ -33,6 +35,9 @@ class TrainedLogisticRegression:
 
         Args:
             data_x (np.array): matrix of predictors, each row is an observation
+            transform_dot (function): if given, data_x is transformed to the
+                predictors by some transform T and this function computes
+                np.dot(T(data_x), coefficients) without materializing T(data_x)
 
         Returns:
             numpy array ``x`` where ``x[:, 0]`` and ``x[:, 1]`` are the
@@ -40,7 +45,11 @@ class TrainedLogisticRegression:
         """
         #logit = lambda p: np.log(p/(1-p))
         logistic = lambda a: 1 / (1 + np.exp(-a))
-        probs = logistic(np.dot(data_x, self.coefficients) + self.bias)
+        if transform_dot is None:
+            linear = np.dot(data_x, self.coefficients)
+        else:
+            linear = transform_dot(data_x, self.coefficients)
+        probs = logistic(linear + self.bias)
         probs = probs[:, np.newaxis]
         return np.hstack([1.0 - probs, probs])
 
@@ -66,4 +75,4 @@ class TrainedLogisticRegression:
 
     def to_dict(self):
         "Serialize TrainedLogisticRegression to Python dictionary"
-        return { 'coef': self.coefficients, 'bias': self.bias }
+        return { 'coef': self.coefficients.tolist(), 'bias': float(self.bias) }
@@ -45,10 +45,12 @@ setup(
         ]
     },
 
-    install_requires=['numpy', 'pysoundfile'],
+    install_requires=['numpy'],
 
     extras_require={
         # dev requirements are needed for training the model
-        'dev': ['pandas', 'scikit-learn']
+        'dev': ['pandas', 'scikit-learn'],
+        # test requirements are needed for generating the test data
+        'test': ['pysoundfile']
     }
 )
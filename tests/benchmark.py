@@ -0,0 +1,229 @@
+"""
+Benchmark each stage of the synchronization pipeline with synthetic inputs
+of different lengths. Run from the repository root:
+
+    PYTHONPATH=. python tests/benchmark.py --output results.json
+
+and compare against a stored baseline, failing if any stage got slower or
+uses more memory by more than the given percentage:
+
+    PYTHONPATH=. python tests/benchmark.py --baseline results.json \
+        --max_regression_percent 20
+
+Peak memory is the peak of numpy and Python allocations in the benchmark
+process as measured by tracemalloc. Work done in worker processes (with
+--parallelism > 1) is not included in it. The startup time of the command
+line tool (autosubsync --help in a new process, for which the peak memory
+is the RSS of that process) is measured separately from the inputs.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from generate_test_data import generate, generate_dummy_model, set_seed
+from autosubsync import features
+from autosubsync import find_transform
+from autosubsync import model
+from autosubsync import preprocessing
+from autosubsync import srt_io
+from autosubsync import synchronize
+
+stages = ['startup', 'parse_srt', 'frame_labels', 'import_audio', 'features', 'predict', \
+    'find_transform', 'transform_srt', 'synchronize']
+
+# stages faster than this are too noisy to detect time regressions
+min_regression_seconds = 0.1
+
+def measure(func, repeat=1):
+    """
+    Run func repeat times
+
+    Returns:
+        tuple (last result, minimum time in seconds, peak memory in bytes)
+    """
+    best = None
+    peak = 0
+    for _ in range(repeat):
+        gc.collect()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # Python < 3.9: restarting clears the peak (and the traces)
+            tracemalloc.stop()
+            tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best, peak
+
+def benchmark_startup(repeat):
+    "Time and peak RSS of autosubsync --help in a new Python process"
+    import re
+    # the peak RSS of the process is printed from /proc on exit (Linux only)
+    code = 'import atexit, sys\n' + \
+        'def peak():\n' + \
+        '    try: sys.stderr.write(open("/proc/self/status").read())\n' + \
+        '    except IOError: pass\n' + \
+        'atexit.register(peak)\n' + \
+        'from autosubsync.main import cli\n' + \
+        'sys.argv[0] = "autosubsync"\n' + \
+        'cli()'
+    def run():
+        return subprocess.run([sys.executable, '-c', code, '--help'], check=True, \
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr
+    status, seconds, _ = measure(run, max(repeat, 3))
+    m = re.search(br'VmHWM:\s*(\d+) kB', status)
+    peak = int(m.group(1))*1024 if m else 0
+    print('  %-16s %9.3f s %9.1f MB' % ('startup', seconds, peak / 2.0**20))
+    return { 'startup': { 'seconds': seconds, 'peak_memory_mb': peak / 2.0**20 } }
+
+def generate_inputs(data_dir, length_minutes):
+    "Generate (or reuse) synthetic sound and subtitles of the given length"
+    base = os.path.join(data_dir, 'bench-%gmin' % length_minutes)
+    sound_file, srt_file = base + '.flac', base + '.srt'
+    if not (os.path.exists(sound_file) and os.path.exists(srt_file)):
+        set_seed(0)
+        generate(sound_file + '.tmp.flac', srt_file, 24/25.0, 4.0, \
+            file_length_seconds=length_minutes*60)
+        os.rename(sound_file + '.tmp.flac', sound_file)
+    return sound_file, srt_file
+
+def benchmark_length(sound_file, srt_file, model_file, work_dir, parallelism, repeat):
+    "Benchmark all stages with one input"
+    results = {}
+    def run(stage, func):
+        result, seconds, peak = measure(func, repeat)
+        results[stage] = { 'seconds': seconds, 'peak_memory_mb': peak / 2.0**20 }
+        print('  %-16s %9.3f s %9.1f MB' % (stage, seconds, peak / 2.0**20))
+        return result
+
+    trained_model = model.load(model_file)
+    sample_rate = 20000
+    frame_size = int(features.frame_secs * sample_rate)
+    output_file = os.path.join(work_dir, 'synced.srt')
+
+    run('parse_srt', lambda: srt_io.read(srt_file))
+
+    samples, sample_rate, data_range = run('import_audio', \
+        lambda: preprocessing.import_sound(sound_file, sample_rate))
+    n_frames = len(samples) // frame_size
+
+    y_subs = run('frame_labels', lambda: preprocessing.import_subs_frames( \
+        srt_file, sample_rate, frame_size, n_frames))
+
+    chunk_size = features.chunk_size_samples(frame_size)
+    data_x = run('features', lambda: np.vstack(list(features.compute_stream( \
+        (samples[i:(i + chunk_size)] for i in range(0, len(samples), chunk_size)), \
+        sample_rate, data_range, parallelism=parallelism))))
+    del samples
+
+    y_scores = run('predict', lambda: model.predict(trained_model, data_x))
+
+    skew, shift, quality = run('find_transform', \
+        lambda: find_transform.find_transform_parameters(y_subs, y_scores, \
+            bias=trained_model[1], parallelism=parallelism))
+
+    run('transform_srt', lambda: preprocessing.transform_srt(srt_file, output_file, \
+        find_transform.parameters_to_transform(skew, shift)))
+
+    run('synchronize', lambda: synchronize(sound_file, srt_file, output_file, \
+        model_file=model_file, parallelism=parallelism))
+
+    return results
+
+def compare(results, baseline, max_regression_percent):
+    """
+    Compare results to a baseline
+
+    Returns:
+        a list of regression descriptions
+    """
+    regressions = []
+    limit = 1 + max_regression_percent / 100.0
+    print('\nchange relative to baseline (time, memory):')
+    for length, stage_results in sorted(results.items()):
+        for stage in stages:
+            new = stage_results.get(stage)
+            old = baseline.get(length, {}).get(stage)
+            if new is None or old is None: continue
+            time_ratio = new['seconds'] / max(old['seconds'], 1e-9)
+            mem_ratio = new['peak_memory_mb'] / max(old['peak_memory_mb'], 1e-3)
+            print('  %-8s %-16s %+7.1f%% %+7.1f%%' % \
+                (length, stage, (time_ratio - 1)*100, (mem_ratio - 1)*100))
+            if time_ratio > limit and new['seconds'] > min_regression_seconds:
+                regressions.append('%s %s: %.3fs -> %.3fs' % \
+                    (length, stage, old['seconds'], new['seconds']))
+            if mem_ratio > limit and new['peak_memory_mb'] > 1:
+                regressions.append('%s %s: %.1fMB -> %.1fMB' % \
+                    (length, stage, old['peak_memory_mb'], new['peak_memory_mb']))
+    return regressions
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('--lengths', default='5,15,60,240',
+        help='Comma-separated input lengths in minutes (default 5,15,60,240)')
+    p.add_argument('--data_dir', default=os.path.join(tempfile.gettempdir(), 'autosubsync-benchmark'),
+        help='Directory for the generated inputs, reused between runs')
+    p.add_argument('--output', default=None, help='Write results to this JSON file')
+    p.add_argument('--baseline', default=None, help='Compare to results in this JSON file')
+    p.add_argument('--max_regression_percent', default=None, type=float,
+        help='With --baseline, fail if any stage is slower or uses more ' + \
+            'memory than the baseline by more than this percentage')
+    p.add_argument('--parallelism', default=1, type=int,
+        help='Parallelism of the feature and search stages (default 1)')
+    p.add_argument('--repeat', default=1, type=int,
+        help='Repeat each stage this many times and report the fastest')
+    args = p.parse_args()
+
+    if not os.path.exists(args.data_dir): os.makedirs(args.data_dir)
+    work_dir = tempfile.mkdtemp()
+    model_file = os.path.join(work_dir, 'model.bin')
+    generate_dummy_model(model_file)
+
+    # warm up: lazy imports and FFT plans
+    features.compute_chunk_features(np.zeros(3000, dtype=np.int16), 2**15, 1000, features.frame_secs)
+
+    tracemalloc.start()
+    print('command line')
+    results = { 'cli': benchmark_startup(args.repeat) }
+    for length in [float(x) for x in args.lengths.split(',')]:
+        print('%g minutes' % length)
+        sound_file, srt_file = generate_inputs(args.data_dir, length)
+        results['%gmin' % length] = benchmark_length(sound_file, srt_file, \
+            model_file, work_dir, args.parallelism, args.repeat)
+    tracemalloc.stop()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({ 'environment': environment(), 'results': results }, \
+                f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, \
+            args.max_regression_percent if args.max_regression_percent is not None else 0)
+        if args.max_regression_percent is not None and regressions:
+            sys.stderr.write('\nREGRESSIONS over %g%%:\n  %s\n' % \
+                (args.max_regression_percent, '\n  '.join(regressions)))
+            sys.exit(1)
@@ -1,4 +1,5 @@
 # encoding: utf-8
+import json
 import numpy as np
 import soundfile
 
@@ -37,27 +38,72 @@ def generate_sound(intervals, file_length_seconds, skew, shift_seconds):
 
     sample_rate = 20000 # Hz
     sound = np.zeros(int(sample_rate*file_length_seconds))
+    for block_start, block in generate_sound_blocks(intervals, \
+        file_length_seconds, skew, shift_seconds, sample_rate):
+        sound[block_start:(block_start + len(block))] = block
+
+    return sound, sample_rate
+
+def generate_sound_blocks(intervals, file_length_seconds, skew, shift_seconds,
+    sample_rate, block_seconds=60, margin_seconds=5):
+    """
+    Generate the sound in consecutive blocks so that long files do not need
+    to fit in memory. Yields tuples (first sample index, samples)
+    """
+    n = int(sample_rate*file_length_seconds)
+    block_size = int(block_seconds*sample_rate)
+    margin = int(margin_seconds*sample_rate)
+    buf = np.zeros(0)
+    buf_start = 0
 
     sync_noise_seconds = 0.1
     noise = lambda: sync_noise_seconds * np.random.randn()
     for interval in intervals:
         t0, t1 = [t * skew + shift_seconds + noise() for t in interval]
-        s = slice(int(t0*sample_rate), int(t1*sample_rate))
-        sound[s] = np.random.randn(len(sound[s]))
+        i0, i1 = [min(max(int(t*sample_rate), 0), n) for t in (t0, t1)]
+        values = np.random.randn(max(i1 - i0, 0))
 
-    return sound, sample_rate
+        if i1 > buf_start + len(buf):
+            buf = np.concatenate([buf, np.zeros(i1 - buf_start - len(buf))])
 
-def generate(sound_file_name, srt_file_name, skew, shift_seconds):
+        # flush blocks that later intervals can no longer overlap
+        while i0 - margin - buf_start >= block_size:
+            yield buf_start, buf[:block_size]
+            buf = buf[block_size:]
+            buf_start += block_size
+        begin = max(i0, buf_start)
+        buf[(begin - buf_start):(i1 - buf_start)] = values[(begin - i0):]
 
-    file_length_seconds = 15 * 60
-    intervals = list(generate_intervals(file_length_seconds))
+    buf = np.concatenate([buf, np.zeros(n - buf_start - len(buf))])
+    for i in range(0, len(buf), block_size):
+        yield buf_start + i, buf[i:(i + block_size)]
 
-    sound, sample_rate = \
-        generate_sound(intervals, file_length_seconds, skew, shift_seconds)
+def generate(sound_file_name, srt_file_name, skew, shift_seconds,
+    file_length_seconds=15*60):
 
-    soundfile.write(sound_file_name, sound, sample_rate)
+    sample_rate = 20000 # Hz
+    intervals = list(generate_intervals(file_length_seconds))
+
+    with soundfile.SoundFile(sound_file_name, 'w', sample_rate, channels=1) as f:
+        for _, block in generate_sound_blocks(intervals, file_length_seconds, \
+            skew, shift_seconds, sample_rate):
+            f.write(block)
     write_texts(srt_file_name, intervals)
 
+def generate_dummy_model(filename):
+    "A model that works with the generated data"
+    DUMMY_MODEL = {
+        'bias': 0.0,
+        'logistic_regression': {
+            'bias': -1.0,
+            'coef': [
+                [1.0] * 250
+            ]
+        }
+    }
+    with open(filename, 'w') as f:
+        json.dump(DUMMY_MODEL, f)
+
 def set_seed(s):
     np.random.seed(s)
 
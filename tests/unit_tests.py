@@ -1,68 +1,604 @@
-import unittest, os, tempfile, json
+import unittest, os, tempfile, json, time
+
+import numpy as np
 
 #from autosubsync import xyz
-from generate_test_data import generate, set_seed
-from autosubsync import synchronize
-
-def generate_dummy_model(filename):
-    DUMMY_MODEL = {
-        'bias': 0.0,
-        'logistic_regression': {
-            'bias': -1.0,
-            'coef': [
-                [1.0] * 250
-            ]
-        }
-    }
-    with open(filename, 'w') as f:
-        json.dump(DUMMY_MODEL, f)
+from generate_test_data import generate, generate_dummy_model, set_seed
+from autosubsync import synchronize, synchronize_many
+from autosubsync import batch
+from autosubsync import cache
+from autosubsync import features
+from autosubsync import find_transform
+from autosubsync import model
+from autosubsync import piecewise
+from autosubsync import preprocessing
+from autosubsync import profiling
+from autosubsync import quality_of_fit
+from autosubsync import server
+from autosubsync import sharedmem
+from autosubsync import srt_io
+
+def generate_subtitle_frames(length_secs):
+    "Random subtitle frame labels"
+    n = int(length_secs / find_transform.frame_secs)
+    y_subs = np.zeros(n, dtype=np.float32)
+    t = 0
+    while t < n:
+        speech = int(np.random.exponential(100))
+        y_subs[t:(t+speech)] = 1
+        t += speech + int(np.random.exponential(80))
+    return y_subs
+
+def generate_speech_probabilities(y_subs, skew, shift_seconds, noise=0.3):
+    "Noisy speech probabilities matching transformed subtitle frame labels"
+    n = len(y_subs)
+    targets = np.round(np.arange(n)*skew + shift_seconds / find_transform.frame_secs).astype(int)
+    valid = (targets >= 0) & (targets < n)
+    speech = np.zeros(n)
+    speech[targets[valid]] = y_subs[valid]
+    return np.clip(0.25 + 0.5*speech + noise*np.random.randn(n), 0, 1)
+
+def generate_dummy_subs(n, length_secs, seed=0):
+    "Random SrtEntry-like subtitle lines"
+    class Line: pass
+    rng = np.random.RandomState(seed)
+    subs = []
+    for t0 in np.sort(rng.rand(n) * length_secs):
+        line = Line()
+        line.begin, line.end, line.text = t0, t0 + rng.exponential(3), b'x'
+        subs.append(line)
+    return subs
+
+# true parameters of the data generated by make_sync_inputs
+sync_skew = 24/25.0
+sync_shift_seconds = 4.0
+
+def make_sync_inputs(tmp_dir):
+    """
+    Generate a dummy model and sound with subtitles out of sync by
+    sync_skew and sync_shift_seconds
+
+    Returns:
+        tuple (sound_file, subtitle_file, model_file) in tmp_dir
+    """
+    set_seed(0)
+    temp_sound = os.path.join(tmp_dir, 'sound.flac')
+    temp_subs = os.path.join(tmp_dir, 'subs.srt')
+    temp_model = os.path.join(tmp_dir, 'model.bin')
+    generate_dummy_model(temp_model)
+    generate(temp_sound, temp_subs, sync_skew, sync_shift_seconds)
+    return temp_sound, temp_subs, temp_model
 
 class TestSync(unittest.TestCase):
     def test_sync(self):
+        profiler = profiling.Profiler()
+        self.check_sync(profiler=profiler)
+        report = profiler.report()
+        self.assertEqual(report['counters']['frames'], 18000)
+        self.assertEqual(report['counters']['skews_tried'], 7)
+        for stage in ['decode', 'features', 'predict', 'search', 'write']:
+            self.assertIn(stage, report['stages'])
+
+    def test_sync_sampled_segments(self):
+        profiler = profiling.Profiler()
+        self.check_sync(sampled_segments=4, sampled_segment_secs=60, profiler=profiler)
+        fraction = profiler.report()['counters']['analyzed_fraction']
+        # 4 minutes of the 15-minute audio
+        self.assertAlmostEqual(fraction, 4/15.0, places=2)
+
+    def test_sync_thread_executor(self):
+        with features.Executor(2, backend='thread') as executor:
+            self.check_sync(executor=executor)
+
+    def check_sync(self, **kwargs):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+
+            # seems to work with FFMPEG without wrapping into a video file
+            video_file = temp_sound
+
+            self.assert_synced(synchronize(video_file, temp_subs, \
+                os.path.join(tmp_dir, 'synced.srt'), model_file=temp_model, \
+                verbose=True, return_parameters=True, **kwargs))
+
+    def assert_synced(self, result):
+        "Check the (success, quality, skew, shift) of a sync of make_sync_inputs"
+        success, quality, skew, shift = result
+        self.assertTrue(success)
+        self.assertEqual(skew, sync_skew)
+        # not very accurate with short/toy data
+        self.assertTrue(abs(shift - sync_shift_seconds) < 1.0)
+
+    def test_sync_many(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+
+            # the same subtitles twice, e.g., in different languages
+            with open(temp_subs) as f: subs_data = f.read()
+            subtitle_files = [temp_subs, os.path.join(tmp_dir, 'subs2.srt')]
+            with open(subtitle_files[1], 'w') as f: f.write(subs_data)
+            output_files = [os.path.join(tmp_dir, 'synced%d.srt' % i) for i in range(2)]
+
+            results = synchronize_many(temp_sound, subtitle_files, output_files, \
+                model_file=temp_model, return_parameters=True, parallelism=2)
+
+            self.assertEqual(len(results), 2)
+            for result, out in zip(results, output_files):
+                self.assert_synced(result)
+                self.assertTrue(os.path.exists(out))
+
+    def test_sync_subtitle_stream(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+            temp_video = os.path.join(tmp_dir, 'video.mkv')
+            preprocessing.run_ffmpeg(['-i', temp_sound, '-i', temp_subs, \
+                '-map', '0:a', '-map', '1:s', '-c:a', 'copy', '-c:s', 'srt', '-y', temp_video])
+
+            output_file = os.path.join(tmp_dir, 'synced.srt')
+            self.assert_synced(synchronize(temp_video, None, output_file, \
+                model_file=temp_model, return_parameters=True, subtitle_stream='s:0'))
+            self.assertEqual(len(srt_io.read(output_file)), \
+                len(srt_io.read(temp_subs)))
+
+    def test_server(self):
+        import threading, urllib.request, urllib.error
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+
+            service = server.SyncService(model_file=temp_model, parallelism=2, \
+                parallel_backend='thread')
+            httpd = server.create_server(service, port=0)
+            url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.start()
+
+            def post(job):
+                request = urllib.request.Request(url + '/sync', json.dumps(job).encode('utf-8'))
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        return response.status, json.loads(response.read().decode('utf-8'))
+                except urllib.error.HTTPError as e:
+                    return e.code, json.loads(e.read().decode('utf-8'))
+
+            try:
+                job = { 'video_file': temp_sound, 'subtitle_file': temp_subs, \
+                    'output_file': os.path.join(tmp_dir, 'synced.srt') }
+                for _ in range(2):
+                    status, result = post(job)
+                    self.assertEqual(status, 200)
+                    self.assert_synced([result[k] for k in ['success', 'quality', 'skew', 'shift']])
+                    # the model is loaded only once
+                    self.assertNotIn('load_model', result['timings'])
+
+                self.assertEqual(post(dict(job, unknown=1))[0], 400)
+                self.assertEqual(post(dict(job, max_shift_secs='20'))[0], 400)
+                self.assertEqual(post(dict(job, fixed_skew='x'))[0], 400)
+                status, result = post(dict(job, fixed_skew=1.0))
+                self.assertEqual(status, 200)
+                self.assertEqual(result['skew'], 1.0)
+                self.assertEqual(post(dict(job, video_file='nonexistent.mp4'))[0], 500)
+
+                with urllib.request.urlopen(url + '/health') as response:
+                    health = json.loads(response.read().decode('utf-8'))
+                self.assertEqual(health['completed'], 3)
+                self.assertEqual(health['failed'], 1)
+                self.assertEqual(health['queued'], 0)
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+                thread.join()
+                service.close()
+
+    def test_synchronize_async(self):
+        import asyncio
+        from autosubsync.aio import synchronize_async
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+            outputs = [os.path.join(tmp_dir, 'synced%d.srt' % i) for i in range(3)]
+
+            async def run():
+                # two concurrent syncs and one cancelled during decoding
+                cancelled = asyncio.ensure_future(synchronize_async(temp_sound, \
+                    temp_subs, outputs[2], model_file=temp_model))
+                syncs = asyncio.gather(*[synchronize_async(temp_sound, temp_subs, \
+                    out, model_file=temp_model, return_parameters=True) \
+                    for out in outputs[:2]])
+                await asyncio.sleep(0.1)
+                cancelled.cancel()
+                with self.assertRaises(asyncio.CancelledError): await cancelled
+                return await syncs
+
+            results = asyncio.run(run())
+            for result in results: self.assert_synced(result)
+            self.assertTrue(all(os.path.exists(out) for out in outputs[:2]))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), \
+                ['model.bin', 'sound.flac', 'subs.srt', 'synced0.srt', 'synced1.srt'])
+
+    def test_synchronize_async_options(self):
+        import asyncio
+        from autosubsync.aio import synchronize_async
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            output_file = os.path.join(tmp_dir, 'synced.srt')
+
+            # unsupported options are rejected before starting ffmpeg
+            with self.assertRaises(TypeError):
+                asyncio.run(synchronize_async(temp_sound, temp_subs, output_file, \
+                    model_file=temp_model, sampled_segments=4))
+            self.assertFalse(os.path.exists(output_file))
+
+            for _ in range(2):
+                self.assert_synced(asyncio.run(synchronize_async(temp_sound, \
+                    temp_subs, output_file, model_file=temp_model, \
+                    return_parameters=True, cache_dir=cache_dir, max_shift_secs=10.0)))
+            self.assertEqual(len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]), 1)
+
+class TestFindTransform(unittest.TestCase):
+    def test_shift_score_curve(self):
         set_seed(0)
+        n = 2000
+        y_subs = (np.random.rand(n) < 0.4).astype(np.float32)
+        y_probs = np.random.rand(n)
+        shifts = range(-300, 301)
 
-        temp_sound = '/tmp/sound.flac'
-        temp_subs = 'tmp/subs.srt'
+        def reference_score(shift, skew):
+            # sub_score with the tie rule of shift_score_curve: the label of
+            # frame i goes to frame round(i*skew) + shift
+            targets = np.round(np.arange(n)*skew).astype(int) + shift
+            valid = (targets >= 0) & (targets < n)
+            y_shift = np.zeros(n)
+            y_shift[targets[valid]] = y_subs[valid]
+            penalty_factor = 1.0 - np.sum(y_subs[~valid]) / float(n)
+            return find_transform.score_function(y_shift, y_probs) * penalty_factor
 
-        tmp_dir = tempfile.mkdtemp()
-        temp_sound = os.path.join(tmp_dir, 'sound.flac')
-        temp_subs = os.path.join(tmp_dir, 'subs.srt')
-        temp_out = os.path.join(tmp_dir, 'synced.srt')
-        temp_model = os.path.join(tmp_dir, 'model.bin')
+        # all skews of the default grid, including 25/24 and 23.976/24 with
+        # exact half-frame ties
+        skews = find_transform.get_skew_pairs([23.976, 24, 25])[0]
+        self.assertEqual(len(skews), 7)
+        for skew in skews:
+            expected = [reference_score(s, skew) for s in shifts]
+            scores = find_transform.shift_score_curve(y_subs, y_probs, shifts, skew)
+            np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-6)
 
-        def run_test():
-            generate_dummy_model(temp_model)
+        # without ties, the same as sub_score
+        for skew in [1.0, 24/25.0, 23.976/25]:
+            expected = [find_transform.sub_score(y_subs, y_probs, s, skew) for s in shifts]
+            scores = find_transform.shift_score_curve(y_subs, y_probs, shifts, skew)
+            np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-6)
 
-            true_skew = 24/25.0
-            true_shift_seconds = 4.0
+    def test_coarse_to_fine_search(self):
+        set_seed(0)
+        y_subs = generate_subtitle_frames(30*60)
+        y_probs = generate_speech_probabilities(y_subs, 24/25.0, -187.3)
 
-            generate(temp_sound, temp_subs, true_skew, true_shift_seconds)
+        skew, shift, quality = find_transform.find_transform_parameters(\
+            y_subs, y_probs, coarse_shift_secs=600, parallelism=1)
 
-            # seems to work with FFMPEG without wrapping into a video file
-            video_file = temp_sound
+        self.assertEqual(skew, 24/25.0)
+        self.assertTrue(abs(shift - -187.3) < 0.5)
+
+    def test_estimate_skew(self):
+        set_seed(0)
+        y_subs = generate_subtitle_frames(60*60)
+        y_probs = generate_speech_probabilities(y_subs, 0.995, 12.0)
+
+        skew, shift, residual = find_transform.estimate_drift(y_subs, y_probs)
+        self.assertTrue(abs(skew - 0.995) < 1e-4)
+        self.assertTrue(residual < 0.5)
+
+        profiler = profiling.Profiler()
+        skew, shift, quality = find_transform.find_transform_parameters(\
+            y_subs, y_probs, estimate_skew=True, parallelism=1, profiler=profiler)
+        self.assertTrue(abs(skew - 0.995) < 1e-4)
+        self.assertTrue(abs(shift - 12.0) < 0.2)
+        self.assertEqual(profiler.report()['counters']['skew_fit_residual_secs'], residual)
+
+        # too little labeled data to fit the drift
+        profiler = profiling.Profiler()
+        find_transform.find_transform_parameters(np.zeros_like(y_subs), y_probs, \
+            estimate_skew=True, parallelism=1, profiler=profiler)
+        self.assertIsNone(profiler.report()['counters']['skew_fit_residual_secs'])
+
+class TestPiecewise(unittest.TestCase):
+    def test_removed_ad_break(self):
+        set_seed(0)
+        frame_secs = find_transform.frame_secs
+
+        # subtitles timed to a recording with a 90s ad break (at 10 min)
+        # that has been removed from the video
+        y_subs = generate_subtitle_frames(20*60)
+        cut_begin, cut_end = int(600 / frame_secs), int(690 / frame_secs)
+        y_subs[cut_begin:cut_end] = 0
+
+        y_probs = generate_speech_probabilities(y_subs, 1.0, 3.0, noise=0.1)
+        y_probs_after = generate_speech_probabilities(y_subs, 1.0, -87.0, noise=0.1)
+        y_probs[(cut_begin + int(3.0 / frame_secs)):] = \
+            y_probs_after[(cut_begin + int(3.0 / frame_secs)):]
+
+        segments = piecewise.find_segments(y_subs, y_probs, 1.0, 3.0)
+
+        self.assertEqual(len(segments), 2)
+        self.assertTrue(abs(segments[0]['shift'] - 3.0) < 0.2)
+        self.assertTrue(abs(segments[1]['shift'] - -87.0) < 0.2)
+        self.assertTrue(540 < segments[1]['begin'] < 720)
+        for s in segments:
+            self.assertTrue(s['quality'] > quality_of_fit.threshold)
+
+class TestFeatures(unittest.TestCase):
+    def test_chunk_features(self):
+        set_seed(0)
+        frame_size, frame_secs = 100, 0.05
+        sound = np.random.randint(-3000, 3000, size=frame_size*300).astype(np.int16)
+        frames = features.split_to_frames(sound, frame_size)
+
+        # straightforward reference implementation
+        extended = features.expand_to_adjacent(frames.astype(np.float64)) / 2**15
+        windowed = extended * np.hanning(extended.shape[1])[np.newaxis, :]
+        np.testing.assert_allclose(features.apply_windowing(frames, 1.0 / 2**15), \
+            windowed, rtol=1e-5, atol=1e-9)
+
+        spectrum = np.abs(np.fft.rfft(windowed, axis=1))
+        frequency = np.arange(spectrum.shape[1]) / (3*frame_secs)
+        spectrum = spectrum[:, (frequency > 20) & (frequency < 20000)]
+        bank_size = spectrum.shape[1] // 50
+        expected = np.hstack([np.log1p(np.sqrt(np.sum( \
+            spectrum[:, (i*bank_size):((i+1)*bank_size)]**2, axis=1)))[:, np.newaxis] \
+            for i in range(50)])
+
+        result = features.compute_chunk_features(sound, 2**15, frame_size, frame_secs)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, rtol=1e-5)
+
+class TestModel(unittest.TestCase):
+    def test_transform_dot(self):
+        set_seed(0)
+        coefficients = np.random.randn(250)
+        for n in [1, 4, 11, 1000]:
+            data_x = np.random.rand(n, 50).astype(np.float32)
+            np.testing.assert_allclose(model.transform_dot(data_x, coefficients), \
+                np.dot(model.transform(data_x), coefficients), rtol=1e-10, atol=1e-10)
+
+    def test_binary_format(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = os.path.join(tmp_dir, 'model.json')
+            binary_file = os.path.join(tmp_dir, 'model.bin')
+            generate_dummy_model(json_file)
+            model.convert(json_file, binary_file)
+
+            with open(binary_file, 'rb') as f:
+                self.assertEqual(f.read(len(model.binary_magic)), model.binary_magic)
+            json_model, binary_model = model.load(json_file), model.load(binary_file)
+            np.testing.assert_array_equal(json_model[0].coefficients, binary_model[0].coefficients)
+            self.assertEqual(json_model[0].bias, binary_model[0].bias)
+            self.assertEqual(json_model[1], binary_model[1])
+            self.assertEqual(model.serialize(json_model), model.serialize(binary_model))
+
+            # cached until the file is replaced
+            self.assertIs(model.load(binary_file)[0], binary_model[0])
+            model.save([binary_model[0], 0.5], binary_file)
+            self.assertEqual(model.load(binary_file)[1], 0.5)
+
+class TestStreaming(unittest.TestCase):
+    def test_predict_stream(self):
+        set_seed(0)
+        trained_model = model.deserialize(json.dumps({
+            'bias': 0.0,
+            'logistic_regression': { 'bias': -1.0, 'coef': list(np.random.randn(250)) }
+        }))
+        data_x = np.random.rand(1000, 50)
+        chunks = [data_x[i:(i+300)] for i in range(0, len(data_x), 300)]
+
+        expected = model.predict(trained_model, data_x)
+        streamed = np.hstack(list(model.predict_stream(trained_model, iter(chunks))))
+        np.testing.assert_allclose(streamed, expected)
+
+    def test_executor(self):
+        set_seed(0)
+        blocks = [np.random.randint(-1000, 1000, size=12000) for _ in range(5)]
+        expected = list(features.compute_stream(iter(blocks), 1000, 2**15, parallelism=1))
+        for backend in ['thread', 'process']:
+            with features.Executor(2, backend=backend) as executor:
+                for _ in range(2): # reusable
+                    result = list(features.compute_stream(iter(blocks), 1000, \
+                        2**15, executor=executor))
+                    self.assertEqual(len(result), len(expected))
+                    for r, e in zip(result, expected):
+                        np.testing.assert_allclose(r, e)
+
+    def test_shared_arrays(self):
+        data = np.arange(1000, dtype=np.int16)
+        with sharedmem.SharedArrays() as shared:
+            handle = shared.share(data)
+            np.testing.assert_array_equal(sharedmem.attach(handle), data)
+            slot_handle = shared.share_in_slot(0, data)
+            shared.share_in_slot(0, data * 2)
+            np.testing.assert_array_equal(sharedmem.attach(slot_handle), data * 2)
+            directories = list(shared.directories.values())
+        self.assertFalse(any(os.path.exists(d) for d in directories))
+
+        # falls back to the temporary directory if /dev/shm is (nearly) full
+        min_free = sharedmem.shm_min_free_bytes
+        sharedmem.shm_min_free_bytes = 2**62
+        try:
+            with sharedmem.SharedArrays() as shared:
+                handle = shared.share(data)
+                self.assertEqual(os.path.dirname(os.path.dirname(handle.path)), \
+                    tempfile.gettempdir())
+                np.testing.assert_array_equal(sharedmem.attach(handle), data)
+        finally:
+            sharedmem.shm_min_free_bytes = min_free
+
+        # disabled: passed as is
+        self.assertIs(sharedmem.SharedArrays(enabled=False).share(data), data)
+
+    def test_frame_labels(self):
+        sample_rate, frame_size, n_frames = 1000, 50, 2000
+        subs = generate_dummy_subs(30, n_frames * frame_size / float(sample_rate))
+        # exactly half of a frame (rounds to 0), over a half, touching
+        # lines and a line past the end
+        for begin, end in [(1.0, 1.025), (2.0, 2.04), (3.01, 3.03), (3.03, 3.04), (99.96, 120)]:
+            subs.append(generate_dummy_subs(1, 1)[0])
+            subs[-1].begin, subs[-1].end = begin, end
+        subvec = preprocessing.build_sub_vec(subs, sample_rate, n_frames * frame_size)
+        expected = np.round(np.mean(features.split_to_frames(subvec, frame_size), axis=1))
+
+        labels = preprocessing.build_frame_labels(subs, sample_rate, frame_size, n_frames)
+        np.testing.assert_array_equal(labels, expected)
+        self.assertEqual(list(labels[[20, 40, 60, 1999]]), [0, 1, 1, 1])
+
+class TestSrtIO(unittest.TestCase):
+    def test_parse_and_write(self):
+        import io
+        data = b'\xef\xbb\xbf1\r\n00:00:01,500 --> 00:00:02,000\r\nfirst\r\nline\r\n\r\n' + \
+            b'2\n00:01:00.250 --> 00:01:01,000  \ntext\n\ncontinued\n\n' + \
+            b'3\n1:2:3,5 --> 1:2:4,25\n\n'
+        subs = srt_io.parse(data)
+        self.assertEqual(list(subs.seq), [1, 2, 3])
+        self.assertEqual(list(subs.begin), [1.5, 60.25, 3723.5])
+        self.assertEqual(list(subs.end), [2.0, 61.0, 3724.25])
+        self.assertEqual(subs.texts(), [b'first\nline', b'text\ncontinued', b''])
+
+        with self.assertRaises(RuntimeError):
+            srt_io.parse(b'1\nfoo --> bar\n')
+
+        # the same output as writing entry by entry
+        expected, output = io.BytesIO(), io.BytesIO()
+        entry_writer = srt_io.writer(expected)
+        for entry in subs: entry_writer.write(entry.begin * 2, entry.end * 2, entry.text)
+        srt_io.writer(output).write_many(subs.begin * 2, subs.end * 2, subs.texts())
+        self.assertEqual(output.getvalue(), expected.getvalue())
+        self.assertEqual(srt_io.parse(output.getvalue()).texts(), subs.texts())
+
+class TestBatch(unittest.TestCase):
+    def test_manifest_and_resume(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = os.path.join(tmp_dir, 'manifest.csv')
+            with open(manifest, 'w') as f:
+                f.write('subtitle_file,video_file,output_file\n' + \
+                    'a.srt,a.mp4,a-synced.srt\n' + \
+                    'b.srt,b.mp4,b-synced.srt\n' + \
+                    'a.fi.srt,a.mp4,a-synced.fi.srt\n')
+            jobs = batch.read_manifest(manifest)
+            self.assertEqual(jobs[0], { 'video_file': 'a.mp4', \
+                'subtitle_file': 'a.srt', 'output_file': 'a-synced.srt' })
+
+            groups = batch.group_by_video(jobs)
+            self.assertEqual([g[0] for g in groups], ['a.mp4', 'b.mp4'])
+            self.assertEqual(len(groups[0][1]), 2)
+
+            report = os.path.join(tmp_dir, 'report.jsonl')
+            with open(report, 'w') as f:
+                f.write(json.dumps(dict(jobs[0], success=True)) + '\n')
+                f.write(json.dumps(dict(jobs[1], error='failed')) + '\n')
+                f.write('{"truncated')
+            finished = batch.read_finished(report)
+            self.assertEqual(finished, set([('a.mp4', 'a.srt', 'a-synced.srt')]))
+
+    def test_run_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_sound, temp_subs, temp_model = make_sync_inputs(tmp_dir)
+
+            job = { 'video_file': temp_sound, 'subtitle_file': temp_subs, \
+                'output_file': os.path.join(tmp_dir, 'synced.srt') }
+            report = os.path.join(tmp_dir, 'report.jsonl')
+            records = batch.run_batch([job], report, parallelism=1, \
+                model_file=temp_model, max_shift_secs=10.0)
+            self.assertEqual(len(records), 1)
+            record = records[0]
+            self.assertTrue(record['success'])
+            self.assertEqual(record['parameters'], { 'max_shift_secs': 10.0 })
+            for stage in ['decode', 'features', 'write']:
+                self.assertIn(stage, record['timings'])
+            self.assertIn('skews_tried', record['counters'])
+
+            # the report lines must be strict JSON, e.g., no Infinity or NaN
+            def reject_constant(name): raise ValueError('invalid JSON: ' + name)
+            batch.run_batch([dict(job, output_file=os.path.join(tmp_dir, 'synced2.srt'))], \
+                report, parallelism=1, model_file=temp_model, estimate_skew=True)
+            with open(report) as f:
+                lines = [json.loads(line, parse_constant=reject_constant) for line in f]
+            self.assertEqual(len(lines), 2)
+            self.assertIn('skew_fit_residual_secs', lines[1]['counters'])
+
+class TestProfiling(unittest.TestCase):
+    def test_nested_stages(self):
+        calls = []
+        profiler = profiling.Profiler(callback=lambda *args: calls.append(args[0]))
+        def slow_items():
+            for i in range(3):
+                with profiler.stage('inner'):
+                    time.sleep(0.01)
+                yield i
+        with profiler.stage('outer'):
+            items = list(profiler.iterate('items', slow_items(), counter='n_items'))
+        self.assertEqual(items, [0, 1, 2])
+
+        report = profiler.report()
+        self.assertEqual(report['counters']['n_items'], 3)
+        self.assertEqual(report['stages']['items']['calls'], 4)
+        self.assertEqual(report['stages']['inner']['calls'], 3)
+        # nested time is not counted twice
+        self.assertTrue(report['stages']['inner']['wall_secs'] >= 0.03)
+        self.assertTrue(report['stages']['items']['wall_secs'] < 0.01)
+        self.assertTrue(report['stages']['outer']['wall_secs'] < 0.01)
+        self.assertEqual(calls.count('inner'), 3)
+
+    def test_memory(self):
+        profiler = profiling.Profiler(memory=True)
+        try:
+            with profiler.stage('outer'):
+                with profiler.stage('allocate'):
+                    data = np.ones(4*2**20 // 8)
+                    time.sleep(0.05)
+                    del data
+        finally:
+            profiler.close()
+
+        stages = profiler.report()['stages']
+        self.assertTrue(stages['allocate']['peak_traced_mb'] >= 4)
+        # memory peaks include nested stages
+        self.assertTrue(stages['outer']['peak_traced_mb'] >= 4)
+        self.assertTrue(stages['allocate']['peak_rss_mb'] > 0)
+        self.assertTrue(len(stages['allocate']['top_allocations']) > 0)
+
+class TestCache(unittest.TestCase):
+    def test_put_get_and_evict(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            y_scores = np.random.RandomState(0).uniform(size=1000)
+            speech_cache = cache.SpeechCache(tmp_dir, max_bytes=3000)
+            self.assertIsNone(speech_cache.get('a'))
+            stored = speech_cache.put('a', y_scores)
+            self.assertTrue(np.allclose(stored, y_scores, atol=1e-3))
+            self.assertTrue(np.array_equal(speech_cache.get('a'), stored))
 
-            success, quality, skew, shift = synchronize(\
-                video_file, temp_subs, temp_out,
-                model_file=temp_model,
-                verbose=True, return_parameters=True)
+            # room for one entry only: the least recently used is evicted
+            os.utime(os.path.join(tmp_dir, 'a.npy'), (0, 0))
+            speech_cache.put('b', y_scores)
+            self.assertIsNone(speech_cache.get('a'))
+            self.assertIsNotNone(speech_cache.get('b'))
 
-            skew_error = abs(skew - true_skew)
-            shift_error = abs(shift - true_shift_seconds)
+class TestStartup(unittest.TestCase):
+    # generous, typically a few milliseconds. Importing numpy takes ~100ms
+    import_time_budget_secs = 0.05
 
-            self.assertTrue(success)
-            self.assertEqual(skew_error, 0.0)
-            # not very accurate with short/toy data
-            self.assertTrue(shift_error < 1.0)
+    def test_import_time(self):
+        import subprocess, sys
+        import autosubsync
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(autosubsync.__file__)))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', \
+            'import sys, autosubsync.main; print(",".join(sys.modules))'], \
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
 
-        def clear():
-            for f in [temp_sound, temp_subs, temp_out, temp_model]:
-                try: os.unlink(sound_file)
-                except: pass
-            try: os.rmdir(tmp_dir)
-            except: pass
+        modules = result.stdout.decode('utf-8').strip().split(',')
+        for heavy in ['numpy', 'pkg_resources']:
+            self.assertNotIn(heavy, modules)
 
-        try: run_test()
-        finally: clear()
+        # lines "import time: self [us] | cumulative | module"
+        cumulative = dict((line.split('|')[2].strip(), int(line.split('|')[1])) \
+            for line in result.stderr.decode('utf-8').split('\n')[1:] if '|' in line)
+        self.assertTrue(cumulative['autosubsync'] + cumulative['autosubsync.main'] < \
+            self.import_time_budget_secs * 1e6)
 
 if __name__ == '__main__':
     unittest.main()